@@ -0,0 +1,190 @@
+"""
+    Asynchronous database methods for RoboRegistry, for routes served natively under an ASGI server
+    These mirror the methods in db, but take the user's token and uid explicitly as there is no Flask context.
+    @author: Lucas Bubner, 2023
+"""
+
+import asyncio
+import os
+import weakref
+
+import httpx
+from requests.exceptions import HTTPError
+
+from db import kiosk_check_in_paths
+from fb import config, TIMEOUT
+
+# Connections kept open to Firebase by each event loop, which can each serve many concurrent requests
+ASYNC_POOL_SIZE = int(os.getenv("FIREBASE_ASYNC_POOL_SIZE", 100))
+
+# Clients cannot be shared between event loops, so one is kept for each
+_clients = weakref.WeakKeyDictionary()
+
+
+def _client() -> httpx.AsyncClient:
+    """
+        Get the pooled HTTP client for the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = _clients[loop] = httpx.AsyncClient(
+            base_url=config["databaseURL"],
+            limits=httpx.Limits(max_connections=ASYNC_POOL_SIZE, max_keepalive_connections=ASYNC_POOL_SIZE),
+            timeout=httpx.Timeout(TIMEOUT[1], connect=TIMEOUT[0]),
+            # Only failed connections are retried, as the request will not have been sent
+            transport=httpx.AsyncHTTPTransport(retries=3)
+        )
+    return client
+
+
+async def close() -> None:
+    """
+        Closes the HTTP client of the running event loop, such as when the server shuts down.
+    """
+    client = _clients.pop(asyncio.get_running_loop(), None)
+    if client is not None:
+        await client.aclose()
+
+
+async def _request(method, path, auth=None, params=None, json=None):
+    """
+        Makes a request to the Firebase REST API.
+        @raise HTTPError: if Firebase refused the request, the same as the synchronous client
+    """
+    params = dict(params or {})
+    if auth:
+        params["auth"] = auth
+    res = await _client().request(method, f"/{path}.json", params=params, json=json)
+    if res.is_error:
+        raise HTTPError(f"{res.status_code} {res.reason_phrase}: {res.text}")
+    return res.json()
+
+
+async def get(path, auth=None):
+    """
+        Reads a node from the database.
+    """
+    return await _request("GET", path, auth)
+
+
+async def update(paths: dict, auth=None) -> None:
+    """
+        Writes to several locations in the database in one multi-location update.
+    """
+    await _request("PATCH", "", auth, json=paths)
+
+
+async def get_uid_for(event_id, auth=None) -> str:
+    """
+        Find the event creator for an event.
+    """
+    return str(await get(f"events/{event_id}/creator", auth))
+
+
+async def get_event_version(event_id, auth=None) -> dict:
+    """
+        Gets the top-level fields of an event in a single shallow read, without checking its visibility.
+        See db.get_event_version.
+    """
+    try:
+        event = await _request("GET", f"events/{event_id}", auth, params={"shallow": "true"})
+    except HTTPError:
+        return {}
+    if not isinstance(event, dict):
+        return {}
+    # Nested nodes such as registered are only given as True in a shallow read
+    return {key: value for key, value in event.items() if value is not True}
+
+
+async def get_event_meta(event_id, uid=None, auth=None) -> dict:
+    """
+        Gets an event's metadata from the database, without downloading its registrations.
+        uid is the current user, who may see the event even if it is not visible.
+    """
+    try:
+        event, settings = await asyncio.gather(get_event_version(event_id, auth),
+                                               get(f"events/{event_id}/settings", auth))
+        if not event:
+            return {}
+        event["settings"] = dict(settings)
+        event["uid"] = event_id
+        # Refuse to give the event if it is not visible
+        if event["settings"]["visible"] is False and event["creator"] != uid:
+            return {}
+    except (HTTPError, TypeError, KeyError):
+        # Event does not exist
+        return {}
+    return event
+
+
+async def get_event(event_id, uid=None, auth=None) -> dict:
+    """
+        Gets an event from the database.
+        uid is the current user, who may see the event even if it is not visible.
+    """
+    try:
+        event = dict(await get(f"events/{event_id}", auth))
+        event["uid"] = event_id
+        # Refuse to give the event if it is not visible
+        if event["settings"]["visible"] is False and event["creator"] != uid:
+            return {}
+    except (HTTPError, TypeError):
+        # Event does not exist
+        return {}
+    return event
+
+
+async def get_registration(event_id, key, auth=None) -> dict:
+    """
+        Gets the public registration data of a registration for an event.
+    """
+    try:
+        return dict(await get(f"events/{event_id}/registered/{key}", auth) or {})
+    except (HTTPError, TypeError):
+        return {}
+
+
+async def get_event_data(event_id, auth=None) -> dict:
+    """
+        Get registered data for an event.
+        May only be accessed by the event owner.
+    """
+    # Will raise HTTPError if not authorised, but will return an empty object if no data exists
+    return dict(await get(f"registered_data/{event_id}", auth) or {})
+
+
+async def get_registration_data(event_id, key, auth=None) -> dict:
+    """
+        Get the private data of one registration for an event.
+        May only be accessed by the event owner.
+    """
+    return dict(await get(f"registered_data/{event_id}/{key}", auth) or {})
+
+
+async def get_anon_check_ins(event_id, auth=None) -> dict:
+    """
+        Get all anonymous check-ins for an event.
+        May only be accessed by the event owner.
+    """
+    return dict(await get(f"registered_data/{event_id}/anon_data", auth) or {})
+
+
+async def get_kiosk_check_ins(event_id) -> dict:
+    """
+        Gets the ids of the anonymous check-ins made at kiosks for an event.
+        See db.get_kiosk_check_ins.
+    """
+    try:
+        return dict(await get(f"events/{event_id}/kiosk") or {})
+    except (HTTPError, TypeError):
+        return {}
+
+
+async def kiosk_check_in(event_id, registrations: dict, anon: dict) -> None:
+    """
+        Records check-ins made at a kiosk in one multi-location update.
+        See db.kiosk_check_in.
+    """
+    if paths := kiosk_check_in_paths(event_id, registrations, anon):
+        await update(paths)
@@ -3,21 +3,45 @@
     @author: Lucas Bubner, 2023
 """
 
+import json
+import math
+import os
+import queue
 from datetime import datetime, timedelta
+from time import time
 
-import requests
-from flask import request, redirect, Blueprint, abort, flash
-from flask_login import login_required, login_user
-from pytz import timezone
+from flask import request, redirect, Blueprint, abort, flash, Response
+from flask_login import current_user, login_required, login_user
 from requests.exceptions import MissingSchema, HTTPError
 
 import db
+import registration
+import utils
 from auth import User
-from fb import auth
-from wrappers import must_be_event_owner
+from fb import auth, session
+from wrappers import must_be_event_owner, conditional
 
 api_bp = Blueprint("api", __name__, template_folder="templates")
 
+# Seconds of overlap given between delta-sync cursors, to allow for clock differences between instances
+SYNC_CURSOR_OVERLAP = 5
+# Number of changed registrations above which private data is read in one request, rather than one by one
+SYNC_FULL_READ_THRESHOLD = 25
+
+# Connection pool usage is served at /api/pool_stats to the operators sizing the pool, who are listed by their user id
+# in POOL_STATS_OPERATORS, separated by commas. It is not served to anyone if none are listed
+POOL_STATS_OPERATORS = {uid.strip() for uid in os.getenv("POOL_STATS_OPERATORS", "").split(",") if uid.strip()}
+
+# Registrations are streamed to the manage page if REGISTRATION_STREAMING is "true", otherwise it polls for them
+# Only enable this where responses can be streamed, which is not the case for serverless hosts such as Vercel
+REGISTRATION_STREAMING = os.getenv("REGISTRATION_STREAMING") == "true"
+# Seconds between keep-alive comments on a registration stream
+STREAM_KEEPALIVE = 15
+# Seconds to wait for Firebase to send the initial registration data
+STREAM_SNAPSHOT_TIMEOUT = 20
+# Seconds before a registration stream is ended, so the browser reconnects with a fresh ID token
+STREAM_MAX_AGE = 600
+
 
 @api_bp.route("/api/oauth2callback")
 def callback():
@@ -35,8 +59,55 @@ def callback():
     return redirect("/")
 
 
+def _dashboard_version():
+    """
+        Validator for the dashboard, which changes with the user's events and the date.
+    """
+    index = db.get_user_index()
+    if index.get("index_version") != db.USER_INDEX_VERSION:
+        return None
+    owned = sorted(index.get("owned") or {})
+    registered = sorted(index.get("registered") or {})
+    # Revisions are far smaller to read than the events themselves
+    revisions = db.fan_out(*[lambda event_id=event_id: db.get_event_version(event_id).get("revision")
+                             for event_id in owned + registered])
+    return (datetime.now().date(), owned, registered, revisions), None
+
+
+def registrations_version(event, since):
+    """
+        Validator for event data, which changes with every write to the event or its registrations.
+        event is the event version from a shallow read, and since is the delta-sync cursor requested.
+    """
+    if not event.get("revision"):
+        return None
+    return (event["revision"], since), event.get("modified", 0) / 1000
+
+
+def stats_version(event):
+    """
+        Validator for event stats, which change with every write to the event's registrations.
+        event is the event version from a shallow read.
+    """
+    if not event.get("revision"):
+        return None
+    return (event["revision"],), event.get("modified", 0) / 1000
+
+
+def auto_open_version(event):
+    """
+        Validator for whether an event is open, which changes with the event and the time.
+        event is the event version from a shallow read.
+    """
+    if not event.get("revision"):
+        return None
+    phase, phase_time = utils.EventSchedule.of(event).phase()
+    return (event["revision"], phase), max(event.get("modified", 0) / 1000, phase_time or 0)
+
+
 @api_bp.route("/api/dashboard")
 @login_required
+@conditional(_dashboard_version)
 def api_dashboard():
     """
         Calculates and returns the user's dashboard information in JSON format.
@@ -89,66 +160,249 @@ def api_dashboard():
 
 @api_bp.route("/api/is_auto_open/<string:event_id>")
 @login_required
+@conditional(lambda event_id: auto_open_version(db.get_event_version(event_id)))
 def api_is_auto_open(event_id):
     """
         Determines if an event is automatically open for registration and checkin.
     """
-    event = db.get_event(event_id)
+    event = db.get_event_meta(event_id)
     if not event:
         abort(404)
 
-    tz = timezone(event["timezone"])
-
-    start_time = tz.localize(datetime.strptime(
-        f"{event['date']} {event['start_time']}", "%Y-%m-%d %H:%M"))
-    can_register = start_time > datetime.now(tz)
-
-    can_checkin = start_time < datetime.now(tz) < tz.localize(datetime.strptime(
-        f"{event['date']} {event['end_time']}", "%Y-%m-%d %H:%M"))
-
+    schedule = utils.EventSchedule.of(event)
     return {
-        "can_register": can_register,
-        "can_checkin": can_checkin
+        "can_register": schedule.registration_open(),
+        "can_checkin": schedule.checkin_open()
     }
 
 
 @api_bp.route("/api/registrations/<string:event_id>")
 @login_required
 @must_be_event_owner
+@conditional(lambda event_id: registrations_version(db.get_event_version(event_id), request.args.get("since")))
 def api_event_data(event_id):
     """
         Returns all registered users and their data for an event.
+        With a since=<timestamp> cursor, returns only what has changed since then (see registrations_delta).
     """
-    event = db.get_event(event_id)
-    if not event:
-        return {
-            "error": "NOT_FOUND"
-        }, 404
-
+    since = request.args.get("since", type=int)
     try:
-        data = db.get_event_data(event_id)
+        if since is None:
+            event, data = db.fan_out(lambda: db.get_event(event_id), lambda: db.get_event_data(event_id))
+        else:
+            event = db.get_event(event_id)
+        if not event:
+            return {
+                "error": "NOT_FOUND"
+            }, 404
+        if since is None:
+            return merge_registrations(event.get("registered"), data)
+
+        keys = registrations_changed(event, since)
+        if len(keys) > SYNC_FULL_READ_THRESHOLD:
+            data = db.get_event_data(event_id)
+            anon_data = data.get("anon_data")
+        else:
+            *private, anon_data = db.fan_out(*[lambda uid=uid: db.get_registration_data(event_id, uid) for uid in keys],
+                                             lambda: db.get_anon_check_ins(event_id))
+            data = dict(zip(keys, private))
+        return registrations_delta(event, since, keys, data, anon_data)
     except HTTPError:
         return {
             "error": "FORBIDDEN"
         }, 403
 
-    # Merge public and private data into an object of all data
+
+def registrations_changed(event, since) -> list:
+    """
+        Find the keys of the registrations of an event that changed at or after a timestamp.
+    """
+    # A registration changes when it is made, and again when it is checked in
+    return [uid for uid, registration in (event.get("registered") or {}).items()
+            if max(registration.get("registered_time", 0), _synced_time(registration.get("checkin_data", {}))) >= since]
+
+
+def _synced_time(checkin) -> int:
+    """
+        Find when a check-in was written to the database.
+        Check-ins replayed by an offline kiosk or flushed from the write-behind queue keep the time they were made,
+        and record when they were written as synced.
+    """
+    return max(checkin.get("time", 0), checkin.get("synced", 0))
+
+
+def registrations_delta(event, since, keys, data, anon_data) -> dict:
+    """
+        Build the changes to the registrations of an event since a timestamp.
+        keys are the registrations found by registrations_changed, data holds at least their private data,
+        and anon_data holds all anonymous check-ins.
+        @return: {"changed": registrations in the same format as /api/registrations, with only new anonymous check-ins,
+                  "removed": keys of registrations that were unregistered,
+                  "cursor": timestamp to send as since for the next sync}
+    """
+    cursor = math.floor(time()) - SYNC_CURSOR_OVERLAP
+    registered = event.get("registered") or {}
+    changed = {uid: _merge_registration(uid, registered, data) for uid in keys}
+
+    anon_changed = {key: checkin for key, checkin in (anon_data or {}).items() if _synced_time(checkin) >= since}
+    if anon_changed:
+        changed["anon_checkin"] = anon_changed
+
+    removed = [uid for uid, removed_time in (event.get("removed") or {}).items()
+               if removed_time >= since and uid not in registered]
+    if not changed and not removed:
+        # Keep the same cursor so repeated polls are for the same URL, which the browser can revalidate
+        cursor = since
+
+    return {
+        "changed": changed,
+        "removed": removed,
+        "cursor": cursor
+    }
+
+
+def merge_registrations(registered, data) -> dict:
+    """
+        Merge public and private registration data into an object of all data.
+    """
     bigdata = {}
-    if event.get("registered"):
-        for uid in event["registered"]:
-            user = {}
-            if data:
-                user.update(data[uid])
-            user.update(event["registered"][uid])
-            bigdata[uid] = user
+    for uid in registered or {}:
+        bigdata[uid] = _merge_registration(uid, registered, data)
 
     # Add any anonymous check-in data
-    if data.get("anon_data"):
+    if (data or {}).get("anon_data"):
         bigdata["anon_checkin"] = data["anon_data"]
 
     return bigdata
 
 
+def _merge_registration(uid, registered, data) -> dict | None:
+    """
+        Merge the public and private data of one registration.
+        @return: The merged data, or None if the registration does not exist
+    """
+    if uid == "anon_checkin":
+        return (data or {}).get("anon_data")
+    if uid not in (registered or {}):
+        return None
+    user = {}
+    if data:
+        user.update(data.get(uid) or {})
+    user.update(registered[uid])
+    return user
+
+
+@api_bp.route("/api/registrations/<string:event_id>/stream")
+@login_required
+@must_be_event_owner
+def api_event_stream(event_id):
+    """
+        Streams all registered users and their data for an event as Server-Sent Events.
+        A "snapshot" of all data is sent first, in the same format as /api/registrations,
+        followed by a "delta" for each change, mapping changed keys to their new data (or null if removed).
+        A "stream_error" is sent if the registration data could not be streamed.
+        Only served if REGISTRATION_STREAMING is enabled.
+    """
+    if not REGISTRATION_STREAMING or not db.get_event_meta(event_id):
+        return {
+            "error": "NOT_FOUND"
+        }, 404
+
+    messages = queue.Queue()
+    streams = db.stream_event_registrations(event_id, lambda source, msg: messages.put((source, msg)))
+    return Response(_stream_registrations(streams, messages), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+def _stream_registrations(streams, messages):
+    """
+        Turn messages from the Firebase registration streams into Server-Sent Events.
+    """
+    trees = {"public": None, "private": None}
+    started = time()
+    try:
+        # Each Firebase stream begins by sending all of its data, which together form the snapshot
+        pending = []
+        while trees["public"] is None or trees["private"] is None:
+            try:
+                source, msg = messages.get(timeout=STREAM_KEEPALIVE)
+            except queue.Empty:
+                if time() - started > STREAM_SNAPSHOT_TIMEOUT:
+                    yield _sse("stream_error", {"error": "FORBIDDEN"})
+                    return
+                yield ": keep-alive\n\n"
+                continue
+            if trees[source] is None and msg.get("event") == "put" and msg.get("path") == "/":
+                trees[source] = msg.get("data") or {}
+            else:
+                pending.append((source, msg))
+
+        yield _sse("snapshot", merge_registrations(trees["public"], trees["private"]))
+
+        while time() - started < STREAM_MAX_AGE:
+            if pending:
+                source, msg = pending.pop(0)
+            else:
+                try:
+                    source, msg = messages.get(timeout=STREAM_KEEPALIVE)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+            if msg.get("event") not in ("put", "patch"):
+                # Stream was cancelled or its credentials expired, the browser will reconnect
+                return
+            keys = _apply_stream_message(trees[source], msg)
+            if keys is None:
+                # The whole tree was replaced, so resend everything
+                yield _sse("snapshot", merge_registrations(trees["public"], trees["private"]))
+                continue
+            if source == "private" and "anon_data" in keys:
+                keys = keys - {"anon_data"} | {"anon_checkin"}
+            if source == "private":
+                # The event's stats are kept alongside the private data, but are not a registration
+                keys = keys - {"stats"}
+                if not keys:
+                    continue
+            yield _sse("delta", {key: _merge_registration(key, trees["public"], trees["private"]) for key in keys})
+    finally:
+        db.close_streams(streams)
+
+
+def _apply_stream_message(tree: dict, msg) -> set | None:
+    """
+        Apply a "put" or "patch" message from a Firebase stream to a local copy of its data.
+        @return: The top-level keys that changed, or None if the whole tree was replaced
+    """
+    path = [part for part in msg["path"].split("/") if part]
+    if msg["event"] == "patch":
+        changes = {tuple(path + key.split("/")): value for key, value in (msg.get("data") or {}).items()}
+    elif not path:
+        tree.clear()
+        tree.update(msg.get("data") or {})
+        return None
+    else:
+        changes = {tuple(path): msg.get("data")}
+
+    for parts, value in changes.items():
+        node = tree
+        for part in parts[:-1]:
+            if not isinstance(node.get(part), dict):
+                node[part] = {}
+            node = node[part]
+        if value is None:
+            node.pop(parts[-1], None)
+        else:
+            node[parts[-1]] = value
+    return {parts[0] for parts in changes}
+
+
+def _sse(event, data) -> str:
+    """
+        Format a Server-Sent Event.
+    """
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
 @api_bp.route("/api/changevis/<string:event_id>", methods=["POST"])
 @login_required
 @must_be_event_owner
@@ -156,7 +410,7 @@ def api_change_visibility(event_id):
     """
         Changes the visibility of an event.
     """
-    event = db.get_event(event_id)
+    event = db.get_event_meta(event_id)
     if not event:
         return {
             "error": "NOT_FOUND"
@@ -176,7 +430,7 @@ def api_change_registration(event_id):
     """
         Changes the registration status of an event.
     """
-    event = db.get_event(event_id)
+    event = db.get_event_meta(event_id)
     if not event:
         return {
             "error": "NOT_FOUND"
@@ -196,7 +450,7 @@ def api_change_checkin(event_id):
     """
         Changes the checkin status of an event.
     """
-    event = db.get_event(event_id)
+    event = db.get_event_meta(event_id)
     if not event:
         return {
             "error": "NOT_FOUND"
@@ -217,18 +471,15 @@ def api_manual_regis(event_id):
         Manually register someone for an event.
         request.form contains the normal registration data.
     """
-    if not db.get_event(event_id):
+    event = db.get_event_meta(event_id)
+    if not event:
         return {
             "error": "NOT_FOUND"
         }, 404
-    req = {
-        **request.form,
-        "manual": "true"
-    }
-    res = requests.post(f"{request.host_url}events/register/{event_id}", data=req, cookies=request.cookies,
-                        headers=request.headers, allow_redirects=False)
-    if res.status_code != 200:
-        flash("Registration failed. Please ensure the fields you have entered are valid.", "danger")
+    try:
+        registration.register(event, request.form, getattr(current_user, "data"), override=True)
+    except registration.RegistrationError as e:
+        flash(f"Registration failed: {e.message}", "danger")
     else:
         flash("Registration successful.", "success")
     return redirect(f"/events/manage/{event_id}")
@@ -241,15 +492,13 @@ def api_open_checkin(event_id):
     """
         Open an event check in by overriding the event start time to now.
     """
-    event = db.get_event(event_id)
+    event = db.get_event_meta(event_id)
     if not event:
         return {
             "error": "NOT_FOUND"
         }, 404
 
-    tz = timezone(event["timezone"])
-    start_time = tz.localize(datetime.strptime(
-        f"{event['date']} {event['start_time']}", "%Y-%m-%d %H:%M"))
+    schedule = utils.EventSchedule.of(event)
 
     # Check if the event is not visible
     if not event["settings"]["visible"]:
@@ -262,23 +511,69 @@ def api_open_checkin(event_id):
         return redirect(f"/events/manage/{event_id}")
 
     # If the event has already started then check-in is already open
-    if start_time < datetime.now(tz) < tz.localize(
-            datetime.strptime(f"{event['date']} {event['end_time']}", "%Y-%m-%d %H:%M")):
+    if schedule.checkin_open():
         flash("Check-in is already open.", "warning")
         return redirect(f"/events/manage/{event_id}")
 
     # If the event is over then check-in cannot be opened
-    if datetime.now(tz) >= tz.localize(datetime.strptime(f"{event['date']} {event['end_time']}", "%Y-%m-%d %H:%M")):
+    if schedule.ended():
         flash("Check-in cannot be opened after the event has ended.", "danger")
         return redirect(f"/events/manage/{event_id}")
 
     # If it is not the event date, we cannot open check-in
-    if datetime.now(tz).date() != start_time.date():
+    if not schedule.is_event_day():
         flash("Check-in cannot be opened before the event date.", "danger")
         return redirect(f"/events/manage/{event_id}")
 
     # Override the start time based on the event timezone now
+    tz = schedule.tz
     db.update_event(event_id, {"start_time": datetime.now(tz).strftime("%H:%M")}, {})
 
     flash(f"Check-in has been opened ({datetime.now(tz).strftime('%H:%M')}).", "success")
     return redirect(f"/events/manage/{event_id}")
+
+
+@api_bp.route("/api/stats/<string:event_id>")
+@login_required
+@must_be_event_owner
+@conditional(lambda event_id: stats_version(db.get_event_version(event_id)))
+def api_stats(event_id):
+    """
+        Returns the attendance stats of an event, which are kept as registrations are made and removed.
+    """
+    if not db.get_event_meta(event_id):
+        return {
+            "error": "NOT_FOUND"
+        }, 404
+    try:
+        stats, counters = db.fan_out(lambda: db.get_stats(event_id), lambda: db.get_counters(event_id))
+    except HTTPError:
+        return {
+            "error": "FORBIDDEN"
+        }, 403
+
+    people = {name: stats.get(name, 0) for name in ("students", "mentors", "adults")}
+    return {
+        "registered": counters["total"],
+        "teams": counters["teams"],
+        "checked_in": counters["checked_in"],
+        "anon_checkins": counters["anon_checkins"],
+        "people": people | {"total": sum(people.values())},
+        "declared_people": stats.get("declared_people", {}),
+        "roles": stats.get("roles", {}),
+        "teams_listed": stats.get("teams_listed", 0)
+    }
+
+
+@api_bp.route("/api/pool_stats")
+@login_required
+def api_pool_stats():
+    """
+        Returns the usage of this worker's Firebase connection pool, for sizing FIREBASE_POOL_SIZE.
+        Only served to the operators in POOL_STATS_OPERATORS, as it exposes details of the deployment.
+    """
+    if utils.get_uid() not in POOL_STATS_OPERATORS:
+        return {
+            "error": "NOT_FOUND"
+        }, 404
+    return session.pool_stats()
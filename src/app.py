@@ -17,6 +17,7 @@ from requests.exceptions import HTTPError
 import api
 import db
 import events
+import kiosk
 import utils
 from auth import auth_bp, User
 from wrappers import validate_user
@@ -108,6 +109,10 @@ app.register_blueprint(utils.filter_bp)
 app.register_blueprint(auth_bp)
 app.register_blueprint(api.api_bp)
 app.register_blueprint(events.events_bp)
+app.register_blueprint(kiosk.kiosk_bp)
+
+# Kiosks authenticate with a token in a header rather than a cookie, so they are not open to cross-site requests
+csrf.exempt(kiosk.kiosk_bp)
 
 
 @login_manager.user_loader
@@ -117,12 +122,11 @@ def load_user(ref_token):
     """
     if ref_token:
         try:
-            user = User(ref_token)
+            # User data is cached alongside the token, and is fetched with it for a new session
+            return User(ref_token)
         except HTTPError:
             # Refresh token is no longer valid
             return None
-        user.refresh()
-        return user
     else:
         return None
 
@@ -199,8 +203,9 @@ def settings():
             flash("Name(s) must be less than 16 characters each.")
             return redirect(url_for("settings"))
 
-        # Update the user account info
+        # Update the user account info, replacing the cached copy
         db.mutate_user_data(account)
+        getattr(current_user, "invalidate")()
         getattr(current_user, "refresh")()
 
         # Use cookies to store user preferences
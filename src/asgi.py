@@ -0,0 +1,339 @@
+"""
+    ASGI entry point for RoboRegistry
+    Routes that are polled heavily, and kiosk check-ins, are served natively with the asynchronous database methods
+    in adb, and every other request is served by the Flask app on a thread pool.
+    Serve with any ASGI server, such as: uvicorn asgi:app
+    @author: Lucas Bubner, 2023
+"""
+
+import asyncio
+import json
+import math
+import os
+import re
+from http.cookies import SimpleCookie, CookieError
+from time import time
+from urllib.parse import parse_qsl
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from requests.exceptions import HTTPError
+from werkzeug.http import parse_etags, parse_date, http_date
+
+import adb
+import api
+import kiosk
+import utils
+import wrappers
+from app import app as flask_app
+from auth import User
+
+# Threads serving the Flask app, for all requests that are not served natively
+WSGI_WORKERS = int(os.getenv("ASGI_WSGI_WORKERS", 16))
+
+_wsgi = WSGIMiddleware(flask_app, workers=WSGI_WORKERS)
+_routes = []
+
+
+def route(pattern, method="GET", login=True):
+    """
+        Register a handler to natively serve requests to a path, for logged in users unless login is False.
+        The handler is called with the request, the user (None if login is False), and the named groups of the pattern.
+        It returns (status, headers, body), or None to have the Flask app serve the request instead.
+    """
+
+    def decorator(f):
+        _routes.append((re.compile(pattern), method, login, f))
+        return f
+
+    return decorator
+
+
+class Request:
+    """
+        The parts of an ASGI request used by native routes.
+    """
+
+    def __init__(self, scope, body=b""):
+        self.path = scope["path"]
+        self.headers = {key.decode("latin-1").lower(): value.decode("latin-1") for key, value in scope["headers"]}
+        self.args = dict(parse_qsl(scope["query_string"].decode("latin-1")))
+        self.body = body
+
+    def get_json(self):
+        """
+            Parse the body as JSON, the same as Flask's request.get_json(silent=True).
+            @return: The parsed body, or None if it is not JSON
+        """
+        if self.headers.get("content-type", "").split(";")[0].strip() != "application/json":
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            return None
+
+
+async def app(scope, receive, send):
+    """
+        The ASGI application.
+    """
+    if scope["type"] == "lifespan":
+        return await _lifespan(receive, send)
+    if scope["type"] == "http":
+        for pattern, method, login, handler in _routes:
+            if method != scope["method"] or not (match := pattern.fullmatch(scope["path"])):
+                continue
+            body = await _read_body(receive) if method != "GET" else b""
+            # The body has been read, so it is given again if the request is left to Flask
+            receive = _replay(body, receive)
+            request = Request(scope, body)
+            # Anything other than a valid session, such as a remember me cookie, is left to Flask
+            user = await _current_user(request) if login else None
+            if user or not login:
+                if res := await handler(request, user, **match.groupdict()):
+                    return await _send(send, *res)
+            break
+    await _wsgi(scope, receive, send)
+
+
+async def _read_body(receive) -> bytes:
+    """
+        Reads the whole body of a request.
+    """
+    body = b""
+    while True:
+        message = await receive()
+        if message["type"] != "http.request":
+            break
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    return body
+
+
+def _replay(body, receive):
+    """
+        Gives a request body that has already been read, then anything else the server sends, such as a disconnect.
+    """
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if not sent:
+            sent = True
+            return {"type": "http.request", "body": body, "more_body": False}
+        return await receive()
+
+    return replay
+
+
+async def _lifespan(receive, send):
+    """
+        Handles the startup and shutdown of the server.
+    """
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await adb.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def _current_user(request) -> User | None:
+    """
+        Loads the logged in user from the Flask session cookie.
+        @return: The user, or None if there is no valid session
+    """
+    try:
+        cookie = SimpleCookie(request.headers.get("cookie", "")).get(flask_app.config["SESSION_COOKIE_NAME"])
+    except CookieError:
+        return None
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    if cookie is None or serializer is None:
+        return None
+    try:
+        session = serializer.loads(cookie.value, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return None
+    if not (refresh_token := session.get("_user_id")):
+        return None
+    try:
+        # Users are almost always cached, but a new session has to fetch their tokens
+        return await asyncio.to_thread(User, refresh_token)
+    except HTTPError:
+        return None
+
+
+def _uid(user) -> str:
+    """
+        Fetch the localId for a user.
+    """
+    return user.acc.get("users", [{}])[0].get("localId")
+
+
+def _json(status, data) -> tuple:
+    """
+        Build a JSON response.
+    """
+    return status, [("Content-Type", "application/json")], json.dumps(data).encode()
+
+
+async def _send(send, status, headers, body):
+    """
+        Sends a response.
+    """
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(key.encode("latin-1"), value.encode("latin-1")) for key, value in headers]
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _conditional(request, name, uid, version, respond):
+    """
+        Answers a conditional request the same way as wrappers.conditional, before calling respond for the response.
+        name is the name of the Flask route, so validators are the same whichever way the request is served.
+    """
+    if not version:
+        return await respond()
+    etag, last_modified = wrappers.make_validators(name, uid, version)
+    if wrappers.is_not_modified(etag, last_modified, parse_etags(request.headers.get("if-none-match")),
+                                parse_date(request.headers.get("if-modified-since"))):
+        res = 304, [], b""
+    else:
+        res = await respond()
+        if res is None or res[0] != 200:
+            return res
+    status, headers, body = res
+    headers = headers + [("ETag", f'W/"{etag}"'), ("Cache-Control", "private, no-cache")]
+    if last_modified:
+        headers.append(("Last-Modified", http_date(last_modified)))
+    return status, headers, body
+
+
+@route(r"/api/is_auto_open/(?P<event_id>[^/]+)")
+async def is_auto_open(request, user, event_id):
+    """
+        Determines if an event is automatically open for registration and checkin.
+        See api.api_is_auto_open.
+    """
+
+    async def respond():
+        event = await adb.get_event_meta(event_id, _uid(user), user.token)
+        if not event:
+            return None
+        schedule = utils.EventSchedule.of(event)
+        return _json(200, {
+            "can_register": schedule.registration_open(),
+            "can_checkin": schedule.checkin_open()
+        })
+
+    version = api.auto_open_version(await adb.get_event_version(event_id, user.token))
+    return await _conditional(request, "api_is_auto_open", _uid(user), version, respond)
+
+
+@route(r"/api/registrations/(?P<event_id>[^/]+)")
+async def registrations(request, user, event_id):
+    """
+        Returns all registered users and their data for an event, or what has changed since a cursor.
+        See api.api_event_data.
+    """
+    uid, token = _uid(user), user.token
+    if await adb.get_uid_for(event_id, token) != uid:
+        return None
+    try:
+        since = int(request.args["since"]) if "since" in request.args else None
+    except ValueError:
+        since = None
+
+    async def respond():
+        try:
+            if since is None:
+                event, data = await asyncio.gather(adb.get_event(event_id, uid, token),
+                                                   adb.get_event_data(event_id, token))
+            else:
+                event = await adb.get_event(event_id, uid, token)
+            if not event:
+                return _json(404, {"error": "NOT_FOUND"})
+            if since is None:
+                return _json(200, api.merge_registrations(event.get("registered"), data))
+
+            keys = api.registrations_changed(event, since)
+            if len(keys) > api.SYNC_FULL_READ_THRESHOLD:
+                data = await adb.get_event_data(event_id, token)
+                anon_data = data.get("anon_data")
+            else:
+                *private, anon_data = await asyncio.gather(
+                    *[adb.get_registration_data(event_id, key, token) for key in keys],
+                    adb.get_anon_check_ins(event_id, token))
+                data = dict(zip(keys, private))
+            return _json(200, api.registrations_delta(event, since, keys, data, anon_data))
+        except HTTPError:
+            return _json(403, {"error": "FORBIDDEN"})
+
+    version = api.registrations_version(await adb.get_event_version(event_id, token), request.args.get("since"))
+    return await _conditional(request, "api_event_data", uid, version, respond)
+
+
+async def _kiosk_event(request, event_id):
+    """
+        Authorise a kiosk for an event the same way as kiosk.kiosk_required.
+        @return: (event, None) if the kiosk may check in, or (None, error response)
+    """
+    # The token is checked before anything is read, so invalid tokens cost nothing
+    if not (claims := kiosk.read_token(request.headers.get("authorization"), flask_app.secret_key)):
+        return None, _json(401, {"error": "KIOSK_TOKEN_INVALID"})
+    event = await adb.get_event_meta(event_id)
+    if res := kiosk.refusal(claims, event_id, event):
+        return None, _json(res[1], res[0])
+    return event, None
+
+
+async def _kiosk_apply(event, items, now) -> dict:
+    """
+        Validate and record check-ins from a kiosk.
+        See kiosk._apply.
+    """
+    keys = kiosk.registration_keys(items)
+    recorded_anon, *found = await asyncio.gather(adb.get_kiosk_check_ins(event["uid"]),
+                                                 *[adb.get_registration(event["uid"], key) for key in keys])
+    results, registrations, anon = kiosk.plan(event, items, now, recorded_anon, dict(zip(keys, found)))
+    await adb.kiosk_check_in(event["uid"], registrations, anon)
+    return results
+
+
+@route(r"/api/kiosk/(?P<event_id>[^/]+)/checkin", method="POST", login=False)
+async def kiosk_checkin(request, user, event_id):
+    """
+        Check in a registration or an anonymous user from a kiosk.
+        See kiosk.checkin.
+    """
+    event, error = await _kiosk_event(request, event_id)
+    if error:
+        return error
+    now = math.floor(time())
+    items = kiosk.checkin_items(request.get_json(), now)
+    if not isinstance(items, list):
+        return _json(items[1], items[0])
+    res = kiosk.checkin_response(await _kiosk_apply(event, items, now), items)
+    return _json(res[1], res[0]) if isinstance(res, tuple) else _json(200, res)
+
+
+@route(r"/api/kiosk/(?P<event_id>[^/]+)/batch", method="POST", login=False)
+async def kiosk_batch(request, user, event_id):
+    """
+        Apply check-ins recorded by a kiosk while it was offline, in one write.
+        See kiosk.batch.
+    """
+    event, error = await _kiosk_event(request, event_id)
+    if error:
+        return error
+    items = kiosk.batch_items(request.get_json())
+    if not isinstance(items, list):
+        return _json(items[1], items[0])
+    return _json(200, {
+        "results": await _kiosk_apply(event, items, math.floor(time()))
+    })
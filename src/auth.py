@@ -2,8 +2,14 @@
     User authentication and profile creation for RoboRegistry
     @author: Lucas Bubner, 2023
 """
+import base64
+import hashlib
+import json
 import random
+import threading
+from time import time
 
+from cachetools import TLRUCache
 from flask import Blueprint, render_template, request, redirect, session, make_response, url_for, flash
 from flask_login import current_user, UserMixin, login_required, logout_user, login_user
 from requests.exceptions import HTTPError
@@ -13,6 +19,43 @@ from fb import auth
 
 auth_bp = Blueprint("auth", __name__, template_folder="templates")
 
+# Firebase ID tokens are valid for one hour, reuse them until this many seconds before they expire
+TOKEN_LIFETIME = 3600
+TOKEN_EXPIRY_MARGIN = 300
+
+# Process-local cache of user sessions, keyed by a hash of the refresh token
+# Each entry expires shortly before the ID token it holds
+_user_cache = TLRUCache(maxsize=1024, ttu=lambda _key, entry, _now: entry["expires"], timer=time)
+_user_cache_lock = threading.Lock()
+
+
+def _cache_key(refresh_token) -> str:
+    """
+        Hash a refresh token so it is not kept in memory as a cache key.
+    """
+    return hashlib.sha256(refresh_token.encode()).hexdigest()
+
+
+def _token_expiry(token) -> float:
+    """
+        Read the expiry time of a Firebase ID token from its payload.
+        The token is not verified, as it was just issued to us by Firebase.
+    """
+    try:
+        payload = token.split(".")[1]
+        payload += "=" * (-len(payload) % 4)
+        return float(json.loads(base64.urlsafe_b64decode(payload))["exp"])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return time() + TOKEN_LIFETIME
+
+
+def invalidate_user(refresh_token) -> None:
+    """
+        Remove any cached session state for a refresh token.
+    """
+    with _user_cache_lock:
+        _user_cache.pop(_cache_key(refresh_token), None)
+
 
 class User(UserMixin):
     """
@@ -21,10 +64,40 @@ class User(UserMixin):
 
     def __init__(self, refresh_token):
         self.id = refresh_token
+        with _user_cache_lock:
+            cached = _user_cache.get(_cache_key(refresh_token))
+        if cached:
+            self.token = cached["token"]
+            self.acc = cached["acc"]
+            self.data = cached["data"]
+            self._expires = cached["expires"]
+            return
+        self._load()
+
+    def _load(self):
+        """
+            Refreshes the user's ID token, account info and data from Firebase.
+        """
         # Automatically refresh the user's token
-        self.token = auth.refresh(refresh_token).get("idToken")
-        self.acc = auth.get_account_info(self.token)
-        self.data = None
+        tokens = auth.refresh(self.id)
+        self.token = tokens.get("idToken")
+        # Account info and user data are independent, so are fetched together
+        self.acc, self.data = db.fan_out(lambda: auth.get_account_info(self.token),
+                                         lambda: db.get_user_data(tokens.get("localId"), self.token))
+        self._expires = _token_expiry(self.token) - TOKEN_EXPIRY_MARGIN
+        self._store()
+
+    def _store(self):
+        """
+            Saves the user's current state into the session cache.
+        """
+        with _user_cache_lock:
+            _user_cache[_cache_key(self.id)] = {
+                "token": self.token,
+                "acc": self.acc,
+                "data": self.data,
+                "expires": self._expires
+            }
 
     def is_email_verified(self):
         """
@@ -37,6 +110,20 @@ class User(UserMixin):
             Refreshes the local instance of user data to reflect data in Firebase.
         """
         self.data = db.get_user_data(self.acc.get("users")[0].get("localId"), self.token)
+        self._store()
+
+    def reload(self):
+        """
+            Discards all cached state and fetches the user's token, account info and data again.
+        """
+        self.invalidate()
+        self._load()
+
+    def invalidate(self):
+        """
+            Removes this user from the session cache.
+        """
+        invalidate_user(self.id)
 
 
 @auth_bp.route("/login", methods=["GET", "POST"])
@@ -122,6 +209,7 @@ def logout():
     """
     should_persist_flashes = request.args.getlist('should_persist_flashes')
     res = make_response(redirect(url_for("auth.login")))
+    getattr(current_user, "invalidate", lambda: None)()
     session.clear()
     logout_user()
     for f in should_persist_flashes:
@@ -158,6 +246,8 @@ def verify():
     """
         Page for users to verify their email address.
     """
+    # The cached account info may be stale if the user has just followed their verification link
+    getattr(current_user, "reload")()
     if getattr(current_user, "is_email_verified", lambda: False)():
         return redirect("/")
     try:
@@ -205,6 +295,7 @@ def create_profile():
         # Create the user's profile
         db.mutate_user_data({"first_name": first_name.strip(), "last_name": last_name.strip(),
                              "role": role, "email": email, "promotion": promotion, "affil": affil.strip()})
+        getattr(current_user, "refresh")()
 
         return redirect("/")
     else:
@@ -267,6 +358,7 @@ def deleteaccount():
 
         db.delete_all_user_events()
         db.delete_user_data()
+        getattr(current_user, "invalidate")()
 
         return redirect(
             url_for("auth.logout", should_persist_flashes=["Account deleted. Thank you for using RoboRegistry."]))
@@ -3,16 +3,433 @@
     @author: Lucas Bubner, 2023
 """
 
+import contextvars
+import json
 import math
-from datetime import datetime
-from time import time
+import os
+import random
+import re
+import threading
+import warnings
+from concurrent.futures import ThreadPoolExecutor, wait
+from time import time, sleep
 
+from flask import g, has_app_context
 from flask_login import current_user
-from pytz import timezone
 from requests.exceptions import HTTPError
 
 import utils
 from fb import db
+from writebehind import WriteBehindQueue
+
+# Keys under users/<uid> that index a user's events, and are not part of their profile
+USER_INDEX_KEYS = ("owned", "registered", "index_version")
+USER_INDEX_VERSION = 1
+
+# Version of the indexes kept under events/<id>, which are maintained with each registration
+# Version 2 added the registration counters
+EVENT_INDEX_VERSION = 2
+
+# Counters kept under events/<id>/counters
+COUNTERS = ("teams", "total", "checked_in", "anon_checkins")
+# Attempts at claiming a team place before giving up, when other registrations keep changing the count
+TEAM_CLAIM_ATTEMPTS = 20
+# Attempts at claiming or releasing a representing name before giving up, when other registrations keep changing it
+NAME_CLAIM_ATTEMPTS = 5
+
+# Version of the attendance stats kept under registered_data/<id>/stats, which are rebuilt in full when it changes
+STATS_VERSION = 1
+# Attempts at rebuilding an event's stats before giving up, when registrations keep changing them
+STATS_REBUILD_ATTEMPTS = 5
+
+# Threads shared by all requests in this process for making independent reads concurrently
+FAN_OUT_WORKERS = int(os.getenv("DB_FAN_OUT_WORKERS", 8))
+_fan_out_executor = ThreadPoolExecutor(max_workers=FAN_OUT_WORKERS, thread_name_prefix="db-fan-out")
+
+
+# Check-ins are acknowledged once queued, and written in batches, if CHECKIN_WRITE_BEHIND is "true"
+# The queue is only flushed while the process is running, so this is not suitable for serverless deployments
+CHECKIN_WRITE_BEHIND = os.getenv("CHECKIN_WRITE_BEHIND") == "true"
+CHECKIN_FLUSH_MS = int(os.getenv("CHECKIN_FLUSH_MS", 250))
+CHECKIN_QUEUE_PATH = os.getenv("CHECKIN_QUEUE_PATH", "checkin_queue.sqlite3")
+
+
+def _flush_check_ins(paths, event_ids) -> None:
+    """
+        Write a batch of queued check-ins.
+        A batch may be sent again after it was written, such as when the update timed out after Firebase applied it,
+        so check-ins that are already recorded are left out rather than counted twice.
+    """
+    recorded = fan_out(*[lambda path=path: _check_in_recorded(path) for path in paths])
+    now = math.floor(time())
+    # Check-ins keep the time they were made, and record when they were written as synced, so clients syncing
+    # changes since a cursor do not miss those that were queued for longer than the cursor allows for
+    paths = {path: value | ({"synced": now} if value["time"] != now else {})
+             for (path, value), done in zip(paths.items(), recorded) if not done}
+    checked_in, anon = {}, {}
+    for path, value in list(paths.items()):
+        # Paths are events/<id>/registered/<key>/checkin_data or registered_data/<id>/anon_data/<key>
+        _, event_id, tree, key = path.split("/")[:4]
+        if tree == "registered":
+            checked_in[event_id] = checked_in.get(event_id, 0) + 1
+        else:
+            anon[event_id] = anon.get(event_id, 0) + 1
+            # Anonymous check-ins are private to the owner, so whether one is recorded is kept publicly
+            paths[f"events/{event_id}/anon_flushed/{key}"] = value["time"]
+    if not paths:
+        return
+    for event_id in checked_in.keys() | anon.keys():
+        paths |= revision_paths(event_id) | counter_paths(event_id, checked_in=checked_in.get(event_id, 0),
+                                                           anon_checkins=anon.get(event_id, 0))
+    # Check-ins are written without authentication, as the check-in tree is public
+    db.update(paths)
+
+
+def _check_in_recorded(path) -> bool:
+    """
+        Whether a queued check-in has already been written, by its path.
+    """
+    _, event_id, tree, key = path.split("/")[:4]
+    if tree == "registered":
+        return bool(db.child("events").child(event_id).child("registered").child(key).child("checkin_data")
+                    .child("checked_in").get().val())
+    return db.child("events").child(event_id).child("anon_flushed").child(key).get().val() is not None
+
+
+def _write_rejected(e) -> bool:
+    """
+        Whether Firebase refused a write, such as for invalid data or its rules, rather than being unreachable.
+    """
+    # The Firebase client raises an HTTPError wrapping the one from requests, which has the response
+    cause = e.args[0] if isinstance(e, HTTPError) and e.args else None
+    status = getattr(getattr(cause, "response", None), "status_code", None)
+    return status is not None and 400 <= status < 500 and status not in (408, 429)
+
+
+_checkin_queue = WriteBehindQueue(CHECKIN_QUEUE_PATH, CHECKIN_FLUSH_MS / 1000, _flush_check_ins,
+                                  _write_rejected) if CHECKIN_WRITE_BEHIND else None
+
+
+def fan_out(*reads) -> list:
+    """
+        Makes independent reads concurrently, so they take the time of one round trip to Firebase.
+        Each read is a function taking no arguments, which runs with the caller's request context so that the
+        current user's token and the reads memoized during this request are available as usual.
+        Once all reads are finished, the first one (in the order given) to raise has its exception raised,
+        so HTTPError is handled the same way as if the reads were made one after another.
+        @return: The result of each read, in the order given
+    """
+    # Reads made from within a fan out are made in turn, as waiting on the same bounded pool could deadlock it
+    if len(reads) < 2 or threading.current_thread().name.startswith("db-fan-out"):
+        return [read() for read in reads]
+    futures = [_fan_out_executor.submit(contextvars.copy_context().run, read) for read in reads]
+    wait(futures)
+    return [future.result() for future in futures]
+
+
+def _memoize(key: tuple, loader):
+    """
+        Reads a node at most once per request, storing the result on flask.g.
+        Outside of a request the loader is always called.
+    """
+    if not has_app_context():
+        return loader()
+    reads = g.setdefault("db_reads", {})
+    if key not in reads:
+        reads[key] = loader()
+    return reads[key]
+
+
+def _forget(event_id) -> None:
+    """
+        Drops any reads of an event memoized during this request, as it has been written to.
+    """
+    if not has_app_context():
+        return
+    reads = g.get("db_reads", {})
+    for key in [key for key in reads if key[1] == event_id]:
+        del reads[key]
+
+
+def revision_paths(event_id, registrations=False) -> dict:
+    """
+        Paths marking an event as changed, to be included in the multi-location update that changes it.
+        The revision and modified time (in milliseconds) are set by Firebase, so concurrent writes cannot be lost.
+        registrations also marks the event's set of registrations as changed, for a registration being made or
+        removed, which check-ins do not do.
+    """
+    paths = {
+        f"events/{event_id}/revision": {".sv": {"increment": 1}},
+        f"events/{event_id}/modified": {".sv": "timestamp"}
+    }
+    if registrations:
+        paths[f"events/{event_id}/regis_revision"] = {".sv": {"increment": 1}}
+    return paths
+
+
+def counter_paths(event_id, **deltas) -> dict:
+    """
+        Paths that change an event's counters by the given amounts, to be included in the multi-location update
+        that changes what they count. The increments are applied by Firebase, so concurrent writes cannot be lost.
+    """
+    return {f"events/{event_id}/counters/{name}": {".sv": {"increment": delta}}
+            for name, delta in deltas.items() if delta}
+
+
+def _count_registrations(registered) -> dict:
+    """
+        Count the registrations of an event in full, for events from before the counters were kept.
+    """
+    registered = (registered or {}).values()
+    return {
+        "teams": sum(registration.get("role") == "team" for registration in registered),
+        "total": len(registered),
+        "checked_in": sum(bool(registration.get("checkin_data", {}).get("checked_in")) for registration in registered)
+    }
+
+
+def _etag_get(path, auth):
+    """
+        Reads a node through the Firebase REST API along with its ETag, for a conditional write with _etag_put.
+    """
+    # The Firebase client does not return the value read alongside its ETag, so the request is made directly
+    params = {"auth": auth} if auth else {}
+    res = db.requests.get(f"{db.database_url}{path}.json", params=params, headers={"X-Firebase-ETag": "true"})
+    res.raise_for_status()
+    return res
+
+
+def _etag_put(path, value, etag, auth):
+    """
+        Writes a node through the Firebase REST API, only if it still has the given ETag.
+        @return: None if the write succeeded, otherwise the response holding the node's current value and ETag
+    """
+    params = {"auth": auth} if auth else {}
+    res = db.requests.put(f"{db.database_url}{path}.json", params=params, headers={"if-match": etag},
+                          data=json.dumps(value))
+    if res.status_code == 412:
+        return res
+    res.raise_for_status()
+    return None
+
+
+def _backoff(attempt) -> None:
+    """
+        Waits before trying a conditional write again, by a random amount so concurrent writers stop colliding.
+    """
+    if attempt:
+        sleep(random.uniform(0, 0.02 * 2 ** min(attempt, 5)))
+
+
+def claim_team_slot(event_id, limit, auth=None) -> bool:
+    """
+        Conditionally increments an event's team counter, unless it has already reached limit.
+        The counter is written only if it has not changed since it was read, so concurrent registrations cannot
+        both take the last place. Release the place with counter_paths(event_id, teams=-1) if it goes unused.
+        @return: False if the event is full
+    """
+    path = f"events/{event_id}/counters/teams"
+    res = _etag_get(path, auth)
+    for attempt in range(TEAM_CLAIM_ATTEMPTS):
+        _backoff(attempt)
+        teams = res.json() or 0
+        if limit != -1 and teams >= limit:
+            return False
+        # A mismatch gives the current value and its ETag, so we can try again without reading it
+        if not (res := _etag_put(path, teams + 1, res.headers["ETag"], auth)):
+            return True
+    raise HTTPError(f"Could not claim a team place for {event_id} after {TEAM_CLAIM_ATTEMPTS} attempts")
+
+
+def claim_name(event_id, repname, key, auth=None) -> bool:
+    """
+        Conditionally records a representing name in an event's names index for the registration key, unless another
+        registration already has it. The entry is written only if it has not changed since it was read, so concurrent
+        registrations cannot both take the same name. Release the name with release_name if it goes unused.
+        A name still held by a registration that has been removed is taken over, as releasing it may have failed.
+        @return: False if the name is taken
+    """
+    path = f"events/{event_id}/names/{_name_key(repname)}"
+    res = _etag_get(path, auth)
+    for attempt in range(NAME_CLAIM_ATTEMPTS):
+        _backoff(attempt)
+        owner = res.json()
+        if owner is not None and (owner == key or not _name_abandoned(event_id, owner, auth)):
+            return owner == key
+        if not (res := _etag_put(path, key, res.headers["ETag"], auth)):
+            return True
+    raise HTTPError(f"Could not claim a representing name for {event_id} after {NAME_CLAIM_ATTEMPTS} attempts")
+
+
+def release_name(event_id, repname, key, auth=None) -> None:
+    """
+        Removes a representing name from an event's names index, only if it still belongs to the registration key.
+    """
+    path = f"events/{event_id}/names/{_name_key(repname)}"
+    res = _etag_get(path, auth)
+    for attempt in range(NAME_CLAIM_ATTEMPTS):
+        _backoff(attempt)
+        # The name may have been taken by a new registration since this one was removed
+        if res.json() != key:
+            return
+        if not (res := _etag_put(path, None, res.headers["ETag"], auth)):
+            return
+    raise HTTPError(f"Could not release a representing name for {event_id} after {NAME_CLAIM_ATTEMPTS} attempts")
+
+
+def _release_name_later(event_id, repname, key, auth, tombstone=False) -> None:
+    """
+        Releases a representing name, leaving it to be taken over by the next registration for it if that fails.
+        A name is only taken over once its registration is gone and has a removal tombstone, which is written here
+        if tombstone is set, for a registration that was never recorded. This also restores the tombstone of a user
+        who unregistered before, which add_entry clears.
+    """
+    if tombstone:
+        try:
+            db.update({f"events/{event_id}/removed/{key}": math.floor(time())}, auth)
+        except HTTPError:
+            pass
+    try:
+        release_name(event_id, repname, key, auth)
+    except HTTPError as e:
+        warnings.warn(f"Could not release a representing name for {event_id}, leaving it to be taken over: {e}")
+
+
+def _name_abandoned(event_id, owner, auth) -> bool:
+    """
+        Whether the registration holding a representing name has been removed, so the name can be taken over.
+        A registration that is still being recorded has no tombstone, so its name is never taken over.
+    """
+    removed, registration = fan_out(lambda: _shallow_get(f"events/{event_id}/removed/{owner}", auth),
+                                    lambda: _shallow_get(f"events/{event_id}/registered/{owner}", auth))
+    return bool(removed) and registration is None
+
+
+def get_counters(event_id, auth=None) -> dict:
+    """
+        Gets the registration counters of an event, being the teams and total registered, the registrations
+        checked in, and the anonymous check-ins.
+    """
+    auth = auth or getattr(current_user, "token", None)
+
+    def _fetch():
+        if get_event_meta(event_id).get("index_version") == EVENT_INDEX_VERSION:
+            try:
+                counters = dict(db.child("events").child(event_id).child("counters").get(auth).val() or {})
+            except (HTTPError, TypeError):
+                counters = {}
+        else:
+            # Anonymous check-ins are private to the owner, so they are only counted once the event is migrated
+            counters = _count_registrations(get_event(event_id).get("registered"))
+        return {name: counters.get(name, 0) for name in COUNTERS}
+
+    return _memoize(("counters", event_id), _fetch)
+
+
+def _registration_stats(role, private_data) -> dict:
+    """
+        Find what one registration adds to its event's stats, by path under registered_data/<id>/stats.
+    """
+    stats = {f"roles/{role}": 1}
+    for field, name in (("numStudents", "students"), ("numMentors", "mentors"), ("numAdults", "adults")):
+        # Zero is stored as "0", as it is nullish
+        stats[name] = int(private_data.get(field) or 0)
+    if private_data.get("numPeople"):
+        # numPeople is a range such as "5-10", which is counted by how many chose it
+        stats[f"declared_people/{private_data['numPeople']}"] = 1
+    try:
+        stats["teams_listed"] = len(json.loads(private_data.get("teams") or "{}"))
+    except (ValueError, TypeError):
+        pass
+    return stats
+
+
+def stats_paths(event_id, amounts, sign=1) -> dict:
+    """
+        Paths that add a registration's stats from _registration_stats to its event's stats, or remove them with a
+        sign of -1, to be included in the multi-location update that makes or removes the registration.
+        The stats are kept with the private data they come from, so only the event owner can read them.
+    """
+    return {f"registered_data/{event_id}/stats/{path}": {".sv": {"increment": sign * amount}}
+            for path, amount in amounts.items() if amount}
+
+
+def _nest_stats(stats: dict, amounts: dict) -> dict:
+    """
+        Add stats by path, such as from _registration_stats, into a tree of stats as stored in the database.
+    """
+    for name, amount in amounts.items():
+        node = stats
+        *parents, leaf = name.split("/")
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = node.get(leaf, 0) + amount
+    return stats
+
+
+def _flatten_stats(stats: dict, prefix="") -> dict:
+    """
+        Get the stats by path from a tree of stats, the reverse of _nest_stats.
+    """
+    amounts = {}
+    for name, value in stats.items():
+        if isinstance(value, dict):
+            amounts |= _flatten_stats(value, f"{prefix}{name}/")
+        elif isinstance(value, int) and not isinstance(value, bool):
+            amounts[f"{prefix}{name}"] = value
+    return amounts
+
+
+def get_stats(event_id, auth=None) -> dict:
+    """
+        Gets the attendance stats of an event, which are rebuilt if they are missing or out of date.
+        May only be accessed by the event owner.
+    """
+    auth = auth or getattr(current_user, "token", None)
+    stats = db.child("registered_data").child(event_id).child("stats").get(auth).val()
+    if not stats or stats.get("version") != STATS_VERSION or stats.get("stale"):
+        return rebuild_stats(event_id, auth)
+    return dict(stats)
+
+
+def rebuild_stats(event_id, auth=None) -> dict:
+    """
+        Counts the attendance stats of an event from all of its registrations.
+        The stats are replaced only if no registration changed them while they were being counted.
+        May only be performed by the event owner.
+    """
+    auth = auth or getattr(current_user, "token", None)
+    path = f"registered_data/{event_id}/stats"
+    res = _etag_get(path, auth)
+    for attempt in range(STATS_REBUILD_ATTEMPTS):
+        _backoff(attempt)
+        # Reads are not memoized, as they must be made again if the stats changed
+        event, data = fan_out(lambda: _fetch_event(event_id, auth), lambda: _fetch_event_data(event_id, auth))
+        stats = {"version": STATS_VERSION}
+        for key, registration in (event.get("registered") or {}).items():
+            _nest_stats(stats, _registration_stats(registration.get("role"), data.get(key) or {}))
+        if not (res := _etag_put(path, stats, res.headers["ETag"], auth)):
+            # Events from before the stats were kept privately have them in the public event, where they are dropped
+            db.update({f"events/{event_id}/stats": None}, auth)
+            return stats
+    raise HTTPError(f"Could not rebuild the stats of {event_id} after {STATS_REBUILD_ATTEMPTS} attempts")
+
+
+def _name_key(repname) -> str:
+    """
+        Normalise a representing name into a Firebase key for the names index.
+    """
+    name = " ".join(repname.split()).upper()
+    # Firebase keys cannot contain any of . $ # [ ] /, so escape them (and the escape character)
+    return re.sub(r"[.$#\[\]/%]", lambda match: f"%{ord(match.group()):02X}", name)
+
+
+def _rep_name(entity) -> str:
+    """
+        Extract the representing name from an entity string.
+    """
+    # entity has the structure of '{CONTACTNAME} | {REPNAME}'
+    return entity.split(" | ", 1)[1]
 
 
 def get_user_data(uid, auth=None) -> dict:
@@ -26,7 +443,11 @@ def get_user_data(uid, auth=None) -> dict:
         return {}
     if not data:
         return {}
-    return dict(data)
+    data = dict(data)
+    # The event index is stored alongside the profile, but should not be treated as profile data
+    for key in USER_INDEX_KEYS:
+        data.pop(key, None)
+    return data
 
 
 def mutate_user_data(info: dict, auth=None) -> None:
@@ -42,7 +463,8 @@ def get_uid_for(event_id, auth=None) -> str:
         Find the event creator for an event.
     """
     auth = auth or getattr(current_user, "token", None)
-    return str(db.child("events").child(event_id).child("creator").get(auth).val())
+    return _memoize(("uid_for", event_id),
+                    lambda: str(db.child("events").child(event_id).child("creator").get(auth).val()))
 
 
 def add_event(uid, event, auth=None):
@@ -50,17 +472,78 @@ def add_event(uid, event, auth=None):
         Adds an event to the database.
     """
     auth = auth or getattr(current_user, "token", None)
-    db.child("events").child(uid).set(event, auth)
+    _forget(uid)
+    db.update({
+        f"events/{uid}": event | {
+            "index_version": EVENT_INDEX_VERSION,
+            "counters": {name: 0 for name in COUNTERS},
+            "revision": 1,
+            "regis_revision": 1,
+            "modified": {".sv": "timestamp"}
+        },
+        f"registered_data/{uid}/stats": {"version": STATS_VERSION},
+        f"users/{event['creator']}/owned/{uid}": True
+    }, auth)
 
 
-def add_entry(event_id, public_data, private_data, override, auth=None):
+def add_entry(event_id, public_data, private_data, override, auth=None, limit=-1) -> str | None:
     """
         Updates an event in the database to reflect a new registration.
+        The representing name is claimed before anything else is written, so it cannot be registered twice.
+        A team registration is refused if the event already has limit teams, where -1 is unlimited.
+        @return: None if the registration was recorded, otherwise why it was refused, being "REGIS_DISABLED" if the
+                 event is not accepting registrations, "REP_NAME_TAKEN" if another registration has the representing
+                 name, "EVENT_FULL" if it has no team places left, or "REGIS_BUSY" if the name or a team place could
+                 not be claimed while other registrations were being made
     """
     auth = auth or getattr(current_user, "token", None)
+    event = get_event_meta(event_id)
     # Refuse if the event is not accepting registrations
-    if not get_event(event_id)["settings"]["regis"] and not override:
-        return
+    if not event["settings"]["regis"] and not override:
+        return "REGIS_DISABLED"
+
+    # Use a push key instead of the uid for manual registrations to allow for multiple registrations
+    key = db.generate_key() if override else utils.get_uid()
+    if not override:
+        # A user registering again may have a tombstone from unregistering, which would let their name be taken over
+        # while this registration is being recorded (see _name_abandoned)
+        db.update({f"events/{event_id}/removed/{key}": None}, auth)
+    try:
+        if not claim_name(event_id, private_data["repName"], key, auth):
+            return "REP_NAME_TAKEN"
+    except HTTPError:
+        return "REGIS_BUSY"
+    try:
+        refused = _record_entry(event, key, public_data, private_data, override, auth, limit)
+    except Exception:
+        _release_name_later(event_id, private_data["repName"], key, auth, tombstone=True)
+        raise
+    if refused:
+        _release_name_later(event_id, private_data["repName"], key, auth, tombstone=True)
+    return refused
+
+
+def _record_entry(event, key, public_data, private_data, override, auth, limit) -> str | None:
+    """
+        Writes a registration for add_entry, once its representing name has been claimed.
+        @return: None if the registration was recorded, otherwise why it was refused
+    """
+    event_id = event["uid"]
+    teams = 1 if public_data["role"] == "team" else 0
+    claimed = False
+    if teams and limit != -1:
+        if event.get("index_version") != EVENT_INDEX_VERSION:
+            # Events from before the counters were kept count their teams in full, until the owner migrates them
+            if get_counters(event_id)["teams"] >= limit:
+                return "EVENT_FULL"
+        else:
+            try:
+                if not claim_team_slot(event_id, limit, auth):
+                    return "EVENT_FULL"
+            except HTTPError:
+                return "REGIS_BUSY"
+            claimed = True
+    _forget(event_id)
     public_data |= {
         # Only show the first name of the contact
         "entity": f"{private_data['contactName'].split(' ')[0]} | {private_data['repName'].upper()}",
@@ -69,13 +552,30 @@ def add_entry(event_id, public_data, private_data, override, auth=None):
             "time": 0
         }
     }
+    amounts = {path: amount for path, amount in _registration_stats(public_data["role"], private_data).items()
+               if amount}
     if not override:
-        db.child("events").child(event_id).child("registered").child(utils.get_uid()).set(public_data, auth)
-        db.child("registered_data").child(event_id).child(utils.get_uid()).set(private_data, auth)
+        # The registration's part of the stats is kept in the user's index, as they cannot read the private data
+        # it came from when they unregister
+        paths = {f"users/{key}/registered/{event_id}": {"stats": _nest_stats({}, amounts)}}
     else:
-        # Push instead of setting to allow for multiple registrations
-        public_data_push = db.child("events").child(event_id).child("registered").push(public_data, auth)
-        db.child("registered_data").child(event_id).child(public_data_push["name"]).set(private_data, auth)
+        paths = {}
+    # A claimed team place has already been counted
+    paths |= counter_paths(event_id, total=1, teams=0 if claimed else teams)
+    paths |= stats_paths(event_id, amounts)
+    try:
+        # Public and private data are written in one multi-location update so they can never disagree
+        db.update(paths | revision_paths(event_id, registrations=True) | {
+            # Clear any record of a previous unregistration
+            f"events/{event_id}/removed/{key}": None,
+            f"events/{event_id}/registered/{key}": public_data,
+            f"registered_data/{event_id}/{key}": private_data
+        }, auth)
+    except Exception:
+        if claimed:
+            db.update(counter_paths(event_id, teams=-1), auth)
+        raise
+    return None
 
 
 def check_in(event_id, uid=None, auth=None):
@@ -85,13 +585,24 @@ def check_in(event_id, uid=None, auth=None):
     """
     auth = auth or getattr(current_user, "token", None)
     # Refuse if check-ins are not allowed
-    if not get_event(event_id)["settings"]["checkin"]:
+    if not get_event_meta(event_id)["settings"]["checkin"]:
         return
     uid = uid or utils.get_uid()
-    db.child("events").child(event_id).child("registered").child(uid).child("checkin_data").set({
+    # A registration keeps the first time it was checked in, and is only counted once
+    registration = get_registration(event_id, uid)
+    if not registration or registration.get("checkin_data", {}).get("checked_in"):
+        return
+    _forget(event_id)
+    path = f"events/{event_id}/registered/{uid}/checkin_data"
+    data = {
         "checked_in": True,
         "time": math.floor(time())
-    }, auth)
+    }
+    if _checkin_queue:
+        # A registration already waiting to be checked in keeps its first check-in time
+        _checkin_queue.put(path, data, event_id)
+        return
+    db.update(revision_paths(event_id) | counter_paths(event_id, checked_in=1) | {path: data}, auth)
 
 
 def anon_check_in(event_id, affil, name):
@@ -105,17 +616,53 @@ def anon_check_in(event_id, affil, name):
         "time": math.floor(time())
     }
     # Decline if check-ins are not allowed
-    if not get_event(event_id)["settings"]["checkin"]:
+    if not get_event_meta(event_id)["settings"]["checkin"]:
         return
-    db.child("registered_data").child(event_id).child("anon_data").push(data)
+    _forget(event_id)
+    path = f"registered_data/{event_id}/anon_data/{db.generate_key()}"
+    if _checkin_queue:
+        _checkin_queue.put(path, data, event_id)
+        return
+    db.update(revision_paths(event_id) | counter_paths(event_id, anon_checkins=1) | {path: data})
+
+
+def kiosk_check_in(event_id, registrations: dict, anon: dict):
+    """
+        Records check-ins made at a kiosk in one multi-location update.
+        See kiosk_check_in_paths.
+    """
+    if paths := kiosk_check_in_paths(event_id, registrations, anon):
+        _forget(event_id)
+        # Authentication is not required as kiosks are logged out, the same as dynamic check-in
+        db.update(paths)
+
 
+def kiosk_check_in_paths(event_id, registrations: dict, anon: dict) -> dict:
+    """
+        Paths recording check-ins made at a kiosk, or nothing if there are none.
+        registrations maps registration keys to their check-in data, and anon maps the ids kiosks gave to anonymous
+        check-ins to their data. Anonymous check-ins are stored under their id, which is also kept publicly
+        (see get_kiosk_check_ins) so a replayed check-in is neither recorded nor counted twice.
+    """
+    paths = {f"events/{event_id}/registered/{key}/checkin_data": data for key, data in registrations.items()}
+    for check_in_id, data in anon.items():
+        paths[f"registered_data/{event_id}/anon_data/kiosk-{check_in_id}"] = data
+        paths[f"events/{event_id}/kiosk/{check_in_id}"] = data["time"]
+    if not paths:
+        return {}
+    return revision_paths(event_id) | counter_paths(event_id, checked_in=len(registrations),
+                                                    anon_checkins=len(anon)) | paths
 
-def dyn_check_in(event_id, entity):
+
+def get_kiosk_check_ins(event_id) -> dict:
     """
-        Checks in a user from an entity.
+        Gets the ids of the anonymous check-ins made at kiosks for an event, mapped to the time they were made.
+        Anonymous check-ins are private to the event owner, so kiosks use these to tell if one was already recorded.
     """
-    uid = get_uid_for_entity(event_id, entity)
-    check_in(event_id, uid)
+    try:
+        return dict(db.child("events").child(event_id).child("kiosk").get().val() or {})
+    except (HTTPError, TypeError):
+        return {}
 
 
 def get_event(event_id, auth=None):
@@ -123,6 +670,13 @@ def get_event(event_id, auth=None):
         Gets an event from a creator from the database.
     """
     auth = auth or getattr(current_user, "token", None)
+    return _memoize(("event", event_id), lambda: _fetch_event(event_id, auth))
+
+
+def _fetch_event(event_id, auth) -> dict:
+    """
+        Reads an event from the database, hiding it if it is not visible to the current user.
+    """
     try:
         event = db.child("events").child(event_id).get(auth).val()
         event = dict(event)
@@ -136,49 +690,208 @@ def get_event(event_id, auth=None):
     return event
 
 
+def get_event_meta(event_id, auth=None) -> dict:
+    """
+        Gets an event's metadata from the database, without downloading its registrations.
+        Use get_event if the registered subtree is needed.
+    """
+    auth = auth or getattr(current_user, "token", None)
+    return _memoize(("event_meta", event_id), lambda: _fetch_event_meta(event_id, auth))
+
+
+def _fetch_event_meta(event_id, auth) -> dict:
+    """
+        Reads the top-level fields and settings of an event, hiding it if it is not visible to the current user.
+    """
+    # A full read may have already happened during this request, which has everything we need
+    if has_app_context() and ("event", event_id) in g.get("db_reads", {}):
+        event = dict(g.db_reads[("event", event_id)])
+        event.pop("registered", None)
+        return event
+    try:
+        event, settings = fan_out(lambda: get_event_version(event_id, auth),
+                                  lambda: db.child("events").child(event_id).child("settings").get(auth).val())
+        if not event:
+            return {}
+        event = dict(event)
+        event["settings"] = dict(settings)
+        event["uid"] = event_id
+        # Refuse to give the event if it is not visible
+        if event["settings"]["visible"] is False and event["creator"] != utils.get_uid():
+            return {}
+    except (HTTPError, TypeError, KeyError):
+        # Event does not exist
+        return {}
+    return event
+
+
+def get_event_version(event_id, auth=None) -> dict:
+    """
+        Gets the top-level fields of an event in a single shallow read, without checking its visibility.
+        Includes the revision and modified time that change with every write to the event or its registrations,
+        which are missing for events that have not been written to since they were kept, and the registrations
+        revision that changes only when a registration is made or removed.
+        Use get_event_meta for anything shown to the user.
+    """
+    auth = auth or getattr(current_user, "token", None)
+
+    def _fetch():
+        try:
+            event = _shallow_get(f"events/{event_id}", auth)
+        except HTTPError:
+            return {}
+        if not isinstance(event, dict):
+            return {}
+        # Nested nodes such as registered are only given as True in a shallow read
+        # An event has no boolean fields at the top level, so these can all be dropped
+        return {key: value for key, value in event.items() if value is not True}
+
+    return _memoize(("event_version", event_id), _fetch)
+
+
+def get_user_index(auth=None) -> dict:
+    """
+        Gets the current user's event index, being the events they own and have registered for.
+        The index is read once per request, as the dashboard's validator and the dashboard itself both need it.
+    """
+    auth = auth or getattr(current_user, "token", None)
+    uid = utils.get_uid()
+
+    def _fetch():
+        try:
+            index = dict(db.child("users").child(uid).get(auth).val() or {})
+        except (HTTPError, TypeError):
+            return {}
+        return {key: index[key] for key in USER_INDEX_KEYS if key in index}
+
+    return _memoize(("user_index", uid), _fetch)
+
+
+def _shallow_get(path, auth):
+    """
+        Performs a shallow read of a node through the Firebase REST API.
+        Primitive children are returned with their values, and nested objects are returned as True.
+    """
+    # The Firebase client only returns the keys of a shallow query, so the request is made directly
+    params = {"shallow": "true"}
+    if auth:
+        params["auth"] = auth
+    res = db.requests.get(f"{db.database_url}{path}.json", params=params)
+    res.raise_for_status()
+    return res.json()
+
+
+def get_registration(event_id, uid=None, auth=None) -> dict:
+    """
+        Gets the public registration data of a user for an event.
+        No uid will get the registration of the current user.
+    """
+    auth = auth or getattr(current_user, "token", None)
+    uid = uid or utils.get_uid()
+
+    def _fetch():
+        try:
+            return dict(db.child("events").child(event_id).child("registered").child(uid).get(auth).val() or {})
+        except (HTTPError, TypeError):
+            return {}
+
+    return _memoize(("registration", event_id, uid), _fetch)
+
+
 def unregister(event_id, auth=None) -> bool:
     """
         Unregister from an event.
     """
     auth = auth or getattr(current_user, "token", None)
-    event = get_event(event_id)
+    event = get_event_meta(event_id)
 
-    tz = timezone(event["timezone"])
-    tz.localize(datetime.strptime(event["date"] + event["start_time"], "%Y-%m-%d%H:%M"))
-
-    # Disallow unregistration if event has already started/ended or if it is not accepting registrations
-    if datetime.now(tz) > tz.localize(datetime.strptime(event["date"] + event["end_time"], "%Y-%m-%d%H:%M")) or not \
-            event["settings"]["regis"]:
+    # Disallow unregistration if event has ended or if it is not accepting registrations
+    if utils.EventSchedule.of(event).ended() or not event["settings"]["regis"]:
         return False
 
-    db.child("events").child(event_id).child("registered").child(utils.get_uid()).remove(auth)
-    db.child("registered_data").child(event_id).child(utils.get_uid()).remove(auth)
+    uid = utils.get_uid()
+    paths = {
+        f"events/{event_id}/registered/{uid}": None,
+        f"registered_data/{event_id}/{uid}": None,
+        f"users/{uid}/registered/{event_id}": None,
+        # Leave a tombstone so clients syncing changes know to remove this registration
+        f"events/{event_id}/removed/{uid}": math.floor(time())
+    }
+    # Release any team place for other registrations
+    if registration := get_registration(event_id):
+        paths |= counter_paths(event_id, total=-1, teams=-(registration.get("role") == "team"),
+                               checked_in=-bool(registration.get("checkin_data", {}).get("checked_in")))
+        indexed = (get_user_index(auth).get("registered") or {}).get(event_id)
+        if isinstance(indexed, dict) and isinstance(indexed.get("stats"), dict):
+            paths |= stats_paths(event_id, _flatten_stats(indexed["stats"]), -1)
+        else:
+            # Registrations from before their part of the stats was kept cannot be taken out, as only the event
+            # owner can read the data it came from, so the stats are counted again when the owner next reads them
+            paths[f"registered_data/{event_id}/stats/stale"] = True
+
+    _forget(event_id)
+    db.update(paths | revision_paths(event_id, registrations=True), auth)
+    if registration:
+        # The name is released once the registration is gone, unless another registration has since claimed it
+        # The registration is already removed, so this cannot fail the unregistration, and the tombstone lets the
+        # name be taken over if it is not released
+        _release_name_later(event_id, _rep_name(registration["entity"]), uid, auth)
     return True
 
 
 def verify_unique(event_id, repname, auth=None) -> bool:
     """
         Verify a team name is not already registered for an event.
+        This only gives a registration that is bound to fail an early answer, as add_entry claims the name itself.
     """
     auth = auth or getattr(current_user, "token", None)
-    all_registrations = db.child("events").child(event_id).child("registered").get(auth).val()
-    try:
-        all_registrations = dict(all_registrations)
-    except TypeError:
-        # No registrations, has to be unique
+    key = _name_key(repname)
+    owner = db.child("events").child(event_id).child("names").child(key).get(auth).val()
+    if owner and not _name_abandoned(event_id, owner, auth):
+        return False
+    if get_event_meta(event_id).get("index_version") == EVENT_INDEX_VERSION:
         return True
-    for registration in all_registrations.values():
-        if registration["entity"].split(" | ")[1].upper() == repname.upper():
+    # Registrations made before the names index was kept have to be checked in full
+    for registration in (get_event(event_id).get("registered") or {}).values():
+        if _name_key(_rep_name(registration["entity"])) == key:
             return False
     return True
 
 
+def migrate_event_index(event_id, auth=None):
+    """
+        Backfills the indexes of an event from its existing registrations.
+        May only be performed by the event owner.
+    """
+    auth = auth or getattr(current_user, "token", None)
+    event = get_event(event_id)
+    if not event or event["creator"] != utils.get_uid():
+        return
+    paths = {
+        f"events/{event_id}/index_version": EVENT_INDEX_VERSION,
+        f"events/{event_id}/counters": _count_registrations(event.get("registered")) | {
+            "anon_checkins": len(get_anon_check_ins(event_id, auth))
+        }
+    }
+    for key, registration in (event.get("registered") or {}).items():
+        paths[f"events/{event_id}/names/{_name_key(_rep_name(registration['entity']))}"] = key
+    _forget(event_id)
+    db.update(paths, auth)
+
+
 def get_event_data(event_id, auth=None) -> dict:
     """
         Get registered data for an event.
         May only be accessed by the event owner.
     """
     auth = auth or getattr(current_user, "token", None)
+    return _memoize(("event_data", event_id), lambda: _fetch_event_data(event_id, auth))
+
+
+def _fetch_event_data(event_id, auth) -> dict:
+    """
+        Reads the private registration data for an event.
+    """
     # Will raise HTTPError if not authorised, but will return an empty object if no data exists
     try:
         data = dict(db.child("registered_data").child(event_id).get(auth).val())
@@ -187,11 +900,71 @@ def get_event_data(event_id, auth=None) -> dict:
     return data
 
 
+def stream_event_registrations(event_id, handler, auth=None) -> list:
+    """
+        Streams changes to an event's public and private registration data from Firebase.
+        handler is called from the streaming threads with (source, message), where source is "public" or "private".
+        Each stream begins with a "put" message at path "/" holding all the data at that location.
+        May only be accessed by the event owner.
+        @return: The open streams, which must be given to close_streams when finished
+    """
+    auth = auth or getattr(current_user, "token", None)
+    return [
+        db.child("events").child(event_id).child("registered").stream(lambda msg: handler("public", msg), auth),
+        db.child("registered_data").child(event_id).stream(lambda msg: handler("private", msg), auth)
+    ]
+
+
+def close_streams(streams) -> None:
+    """
+        Closes streams opened from Firebase.
+    """
+    for stream in streams:
+        # The stream may still be connecting, or its thread may have failed to connect at all
+        while stream.sse is None and stream.thread.is_alive():
+            sleep(0.01)
+        if stream.sse is not None:
+            stream.close()
+
+
+def get_registration_data(event_id, uid, auth=None) -> dict:
+    """
+        Get the private data of one registration for an event.
+        May only be accessed by the event owner.
+    """
+    auth = auth or getattr(current_user, "token", None)
+    try:
+        return dict(db.child("registered_data").child(event_id).child(uid).get(auth).val() or {})
+    except TypeError:
+        return {}
+
+
+def get_anon_check_ins(event_id, auth=None) -> dict:
+    """
+        Get all anonymous check-ins for an event.
+        May only be accessed by the event owner.
+    """
+    auth = auth or getattr(current_user, "token", None)
+    try:
+        return dict(db.child("registered_data").child(event_id).child("anon_data").get(auth).val() or {})
+    except TypeError:
+        return {}
+
+
 def get_uid_for_entity(event_id, entity) -> str:
     """
         Find the entity creator for an entity.
     """
-    # entity has the structure of '{CONTACTNAME} | {REPNAME}'
+    # entity has the structure of '{CONTACTNAME} | {REPNAME}', and the names index maps each REPNAME to its registration
+    try:
+        uid = db.child("events").child(event_id).child("names").child(_name_key(_rep_name(entity))).get().val()
+    except (HTTPError, IndexError):
+        return ""
+    if uid:
+        return str(uid)
+    if get_event_meta(event_id).get("index_version") == EVENT_INDEX_VERSION:
+        return ""
+    # Events from before the names index was kept have to be searched in full
     event = get_event(event_id)
     if not event:
         return ""
@@ -203,24 +976,105 @@ def get_uid_for_entity(event_id, entity) -> str:
 
 def get_my_events(auth=None) -> tuple[dict, dict]:
     """
-        Gets a user's events from the database.
+        Gets a user's events from the database, using the per-user event index.
         @return: (registered_events, owned_events)
     """
     auth = auth or getattr(current_user, "token", None)
+    uid = utils.get_uid()
+    index = get_user_index(auth)
+    if index.get("index_version") != USER_INDEX_VERSION:
+        # This user has not been indexed yet, so build it from the full events tree
+        return migrate_user_index(auth)
+
+    owned, registered = list(index.get("owned") or {}), list(index.get("registered") or {})
+    # Listing an event only needs its top-level fields, and registered events need their settings for visibility
+    reads = [lambda event_id=event_id: _get_indexed(event_id, auth) for event_id in owned + registered]
+    reads += [lambda event_id=event_id: _get_indexed(event_id, auth, "settings") for event_id in registered]
+    results = fan_out(*reads)
+    events = dict(zip(owned + registered, results))
+    settings = dict(zip(registered, results[len(owned) + len(registered):]))
+
+    registered_events = {}
+    owned_events = {}
+    # Index entries that no longer point to a valid event, such as an event deleted by its owner
+    stale = {}
+    for event_id in owned:
+        event_data = events[event_id]
+        if event_data is None:
+            continue
+        if event_data.get("creator") != uid:
+            stale[f"owned/{event_id}"] = None
+            continue
+        owned_events[event_id] = event_data
+    # The index is kept with every registration, so it is trusted rather than checking each event's registrations
+    for event_id in registered:
+        event_data = events[event_id]
+        if event_data is None or settings[event_id] is None:
+            continue
+        if not event_data:
+            stale[f"registered/{event_id}"] = None
+            continue
+        if settings[event_id].get("visible") is True:
+            registered_events[event_id] = event_data | {"settings": settings[event_id]}
+
+    if stale:
+        db.child("users").child(uid).update(stale, auth)
+    return registered_events, owned_events
+
+
+def _get_indexed(event_id, auth, node=None) -> dict | None:
+    """
+        Reads an event found in a user's event index, or one of its nodes.
+        Without a node, a shallow read gives the top-level fields, without nested nodes such as the registrations.
+        @return: the data, an empty dict if it no longer exists, or None if it could not be read
+    """
+    # The dashboard's validator may have already read the event's top-level fields during this request
+    if node is None and has_app_context() and (event := g.get("db_reads", {}).get(("event_version", event_id))):
+        return dict(event)
+    try:
+        if node is None:
+            data = _shallow_get(f"events/{event_id}", auth)
+            data = {key: value for key, value in data.items() if value is not True} if isinstance(data, dict) else {}
+        else:
+            data = db.child("events").child(event_id).child(node).get(auth).val()
+    except HTTPError:
+        return None
+    return dict(data) if data else {}
+
+
+def migrate_user_index(auth=None) -> tuple[dict, dict]:
+    """
+        Backfills the current user's event index from the full events tree.
+        Used once per user to migrate data from before the index was maintained.
+        @return: (registered_events, owned_events)
+    """
+    auth = auth or getattr(current_user, "token", None)
+    uid = utils.get_uid()
+    indexed = get_user_index(auth).get("registered") or {}
     try:
         events = db.child("events").get(auth).val()
         registered_events = {}
         owned_events = {}
+        # Invisible events are still indexed, as they may be made visible again
+        registered_index = {}
         for event_id, event_data in dict(events).items():
-            if event_data["creator"] == utils.get_uid():
+            if event_data["creator"] == uid:
                 owned_events[event_id] = event_data
                 continue
-            if event_data.get("registered") and utils.get_uid() in event_data["registered"] and event_data.get(
-                    "settings").get("visible") is True:
-                registered_events[event_id] = event_data
+            if event_data.get("registered") and uid in event_data["registered"]:
+                # Keep what registrations made before the migration recorded in the index
+                registered_index[event_id] = indexed.get(event_id, True)
+                if event_data.get("settings").get("visible") is True:
+                    registered_events[event_id] = event_data
     except (HTTPError, TypeError):
         # Events do not exist
-        return {}, {}
+        registered_events, owned_events, registered_index = {}, {}, {}
+
+    db.child("users").child(uid).update({
+        "owned": {event_id: True for event_id in owned_events},
+        "registered": registered_index,
+        "index_version": USER_INDEX_VERSION
+    }, auth)
     return registered_events, owned_events
 
 
@@ -229,11 +1083,16 @@ def delete_event(event_id, auth=None):
         Deletes an event from the database.
     """
     auth = auth or getattr(current_user, "token", None)
-    if db.child("events").child(event_id).child("creator").get(auth).val() != utils.get_uid():
+    if get_uid_for(event_id, auth) != utils.get_uid():
         return
-    # MUST remove registered_data before events, otherwise Firebase cannot determine an owner
-    db.child("registered_data").child(event_id).remove(auth)
-    db.child("events").child(event_id).remove(auth)
+    _forget(event_id)
+    # Security rules for a multi-location update are evaluated against the data before the write,
+    # so Firebase can still determine the owner of registered_data while the event is removed with it
+    db.update({
+        f"registered_data/{event_id}": None,
+        f"events/{event_id}": None,
+        f"users/{utils.get_uid()}/owned/{event_id}": None
+    }, auth)
 
 
 def update_event(event_id, updates: dict, settings: dict, auth=None):
@@ -244,15 +1103,14 @@ def update_event(event_id, updates: dict, settings: dict, auth=None):
     settings |= {"last_modified": math.floor(time())}
 
     # Refuse to update if the event is not owned by the user
-    if db.child("events").child(event_id).child("creator").get(auth).val() != utils.get_uid():
+    if get_uid_for(event_id, auth) != utils.get_uid():
         return
 
-    # Update the event tree based on each node
-    for node, value in updates.items():
-        db.child("events").child(event_id).child(node).set(value, auth)
-
-    for node, value in settings.items():
-        db.child("events").child(event_id).child("settings").child(node).set(value, auth)
+    _forget(event_id)
+    # Update every changed node of the event tree in a single multi-location update
+    paths = {f"events/{event_id}/{node}": value for node, value in updates.items()}
+    paths |= {f"events/{event_id}/settings/{node}": value for node, value in settings.items()}
+    db.update(paths | revision_paths(event_id), auth)
 
 
 def delete_all_user_events():
@@ -8,20 +8,24 @@ import os
 import random
 import re
 from datetime import datetime
-from io import BytesIO
+from io import BytesIO, RawIOBase
 from time import time
 from urllib.parse import urlparse
 from zipfile import ZipFile
 
-from flask import Blueprint, render_template, request, session, redirect, abort, send_file, make_response
+from flask import Blueprint, render_template, request, session, redirect, abort, send_file, make_response, Response
 from flask_login import current_user, login_required, logout_user
-from pytz import all_timezones, timezone
+from pytz import all_timezones
 from requests.exceptions import HTTPError
 
+import api
 import db
 import img
+import kiosk
+import registration
+import roster
 import utils
-from wrappers import must_be_event_owner, event_must_be_running, validate_user
+from wrappers import must_be_event_owner, event_must_be_running, validate_user, conditional
 
 events_bp = Blueprint("events", __name__, template_folder="templates")
 
@@ -47,54 +51,64 @@ def viewall():
                            done_events=done_events, user=getattr(current_user, "data"))
 
 
+def _event_page_version(event_id):
+    """
+        Validator for pages showing an event, which change with the event, its registrations and the time.
+    """
+    event = db.get_event_version(event_id)
+    if not event.get("revision"):
+        return None
+    phase, phase_time = utils.EventSchedule.of(event).phase()
+    return (event["revision"], phase, getattr(current_user, "data")), max(event.get("modified", 0) / 1000, phase_time or 0)
+
+
+def _manage_version(event_id):
+    """
+        Validator for the event management page.
+    """
+    # Events with outdated indexes are migrated when the page is rendered
+    if db.get_event_version(event_id).get("index_version") != db.EVENT_INDEX_VERSION:
+        return None
+    return _event_page_version(event_id)
+
+
 @events_bp.route("/events/view/<string:uid>")
 @login_required
 @validate_user
+@conditional(_event_page_version)
 def viewevent(uid: str):
     """
         View a specific user-owned event.
     """
-    data = db.get_event(uid)
+    data = db.get_event_meta(uid)
     if not data:
         abort(404)
 
-    registered = False
-
-    # Check if the current user is registered for the event
-    if data.get("registered"):
-        for key in data["registered"].keys():
-            if key == utils.get_uid():
-                registered = True
-                break
+    # The registrations are only counted and checked for the current user, so they are not downloaded
+    counters, registration = db.fan_out(lambda: db.get_counters(uid), lambda: db.get_registration(uid))
+    registered = bool(registration)
 
     # Check for ownership
     owned = data.get("creator") == utils.get_uid()
 
     # Calculate time to event
-    tz = timezone(data["timezone"])
-    start_time = tz.localize(datetime.strptime(
-        f"{data['date']} {data['start_time']}", "%Y-%m-%d %H:%M"))
-    end_time = tz.localize(datetime.strptime(
-        f"{data['date']} {data['end_time']}", "%Y-%m-%d %H:%M"))
-
-    time_to_start = utils.get_time_diff(datetime.now(tz), start_time)
-    time_to_end = utils.get_time_diff(datetime.now(tz), end_time)
+    schedule = utils.EventSchedule.of(data)
+    tz = schedule.tz
+    now = datetime.now(tz)
+    time_to_start = utils.get_time_diff(now, schedule.start)
+    time_to_end = utils.get_time_diff(now, schedule.end)
 
     # Determine if a user can register
-    can_register = start_time > datetime.now(tz)
-    offset = tz.utcoffset(datetime.now()).total_seconds() / 3600
+    can_register = schedule.registration_open(now)
+    offset = schedule.utc_offset
 
-    if data.get("registered"):
-        # Summate the number of teams registered
-        team_regis_count = sum([v.get("role") == "team" for v in data["registered"].values()])
-    else:
-        # Cannot be any registered teams if there are no registered users
-        team_regis_count = 0
+    team_regis_count = counters["teams"]
+    regis_count = counters["total"]
 
-    is_running = start_time < datetime.now(tz) < end_time
+    is_running = schedule.checkin_open(now)
 
     return render_template("event/event.html.jinja", user=getattr(current_user, "data"), event=data,
-                           team_regis_count=team_regis_count,
+                           team_regis_count=team_regis_count, regis_count=regis_count,
                            registered=registered, owned=owned, mapbox_api_key=os.getenv("MAPBOX_API_KEY"),
                            time_to_start=time_to_start, time_to_end=time_to_end, is_running=is_running,
                            can_register=can_register, timezone=tz, offset=offset)
@@ -111,7 +125,7 @@ def redirector():
         if not (target := request.form.get("event_url")):
             return render_template("dash/redirector.html.jinja", user=getattr(current_user, "data"),
                                    error="Missing url!")
-        if not (event := db.get_event(target)):
+        if not (event := db.get_event_meta(target)):
             res = make_response(redirect(target))
             # Test to see if it is a url and/or if it is a 404
             target = urlparse(target).hostname
@@ -188,7 +202,7 @@ def create():
             "checkin_code": random.randint(1000, 9999)
         }
 
-        if db.get_event(event_uid):
+        if db.get_event_meta(event_uid):
             return render_template("event/create.html.jinja", error="An event with that name and date already exists.",
                                    user=user, mapbox_api_key=mapbox_api_key, old_data=event, timezones=all_timezones)
 
@@ -214,10 +228,7 @@ def create():
                                        user=user, mapbox_api_key=mapbox_api_key, timezones=all_timezones,
                                        old_data=event)
 
-            tz = timezone(event["timezone"])
-            event_start_time = tz.localize(datetime.strptime(
-                event["date"] + event["start_time"], "%Y-%m-%d%H:%M"))
-            if event_start_time < datetime.now(tz):
+            if not utils.EventSchedule.of(event).registration_open():
                 return render_template("event/create.html.jinja", error="Please enter a date and time in the future.",
                                        user=user, mapbox_api_key=mapbox_api_key, timezones=all_timezones,
                                        old_data=event)
@@ -245,7 +256,7 @@ def delete(event_id: str):
         db.delete_event(event_id)
         return redirect("/events/view")
     else:
-        return render_template("event/delete.html.jinja", event=db.get_event(event_id),
+        return render_template("event/delete.html.jinja", event=db.get_event_meta(event_id),
                                user=getattr(current_user, "data"))
 
 
@@ -256,95 +267,27 @@ def event_register(event_id: str):
     """
         Register a user for an event.
     """
-    event = db.get_event(event_id)
+    # Registering is checked against the event's indexes and counters, so its registrations are not read
+    event = db.get_event_meta(event_id)
     if not event:
         abort(404)
     user = getattr(current_user, "data")
 
-    # Check for manual registration
-    override = False
-    if request.form.get("manual") == "true":
-        # Ensure we are the event owner
-        if event["creator"] != utils.get_uid():
-            return render_template("event/done.html.jinja", event=event, status="Failed: NOT_REGIS_OWNER",
-                                   message="The currently logged in RoboRegistry account is not the owner of this event. Only the owner can manually register users.",
-                                   user=user), 400
-        # Override specific protections as we are the owner
-        override = True
-
-    if event["creator"] == utils.get_uid() and not override:
-        return render_template("event/done.html.jinja", event=event, status="Failed: REGIS_OWNER",
-                               message="The currently logged in RoboRegistry account is the owner of this event. The owner cannot register for their own event.",
-                               user=user), 400
-
-    if event.get("registered") and utils.get_uid() in event["registered"] and not override:
-        return render_template("event/done.html.jinja", event=event, status="Failed: REGIS_ALR",
-                               message="You are already registered for this event. If you wish to unregister from this event, please go to the event view tab and unregister from there.",
+    # Manual registrations are made by the event owner
+    override = request.form.get("manual") == "true"
+    try:
+        if request.method == "POST":
+            registration.register(event, request.form, user, override)
+            return render_template("event/done.html.jinja", event=event, status="Registration successful",
+                                   message="Your registration was successfully recorded. Go to the dashboard to view all your registered events, and remember to bring a smart device for QR code check-in on the day.",
+                                   user=user)
+        registration.check_can_register(event, override)
+    except registration.RegistrationError as e:
+        return render_template("event/done.html.jinja", event=event, status=f"Failed: {e.code}", message=e.message,
                                user=user), 400
 
-    # Check if the event has registration manually disabled
-    if not event["settings"]["regis"] and not override:
-        return render_template("event/done.html.jinja", event=event, user=user, status="Failed: REGIS_DISABLED",
-                               message="Registration for this event has been disabled by the event owner."), 400
-
-    # Check to see if the event is over, and decline registration if it is
-    tz = timezone(event["timezone"])
-    if datetime.now(tz) > tz.localize(
-            datetime.strptime(event["date"] + event["start_time"], "%Y-%m-%d%H:%M")) and not override:
-        return render_template("event/done.html.jinja", event=event, user=user, status="Failed: EVENT_AUTO_CLOSED",
-                               message="This event has already started or has concluded. Registration has been automatically disabled. You may ask the event owner to register you manually if desired."), 400
-
-    if request.method == "POST":
-        role = request.form.get("role")
-        private_data = {
-            "repName": request.form.get("repName"),
-            "teams": request.form.get("teams"),
-            "numPeople": request.form.get("numPeople"),
-            "numStudents": utils.limit_to_999(request.form.get("numStudents")),
-            "numMentors": utils.limit_to_999(request.form.get("numMentors")),
-            "numAdults": utils.limit_to_999(request.form.get("numAdults")),
-            "contactName": request.form.get("contactName"),
-            "contactEmail": request.form.get("contactEmail") or user["email"],
-            "contactPhone": utils.reformat_number(request.form.get("contactPhone")),
-        }
-
-        # Ensure that all required fields are filled
-        if not utils.validate_form(private_data, role):
-            return render_template("event/done.html.jinja", event=event, status="Failed: MISSING_FIELDS",
-                                   message="Please fill out all required fields.", user=user), 400
-
-        # Remove data that is not required
-        for key in list(private_data.keys()):
-            if not private_data[key] or role != "team" and key in (
-                    "numStudents", "numMentors", "numAdults", "numPeople"):
-                del private_data[key]
-
-        # Check if the repName is already taken
-        if not db.verify_unique(event_id, private_data["repName"]):
-            return render_template("event/done.html.jinja", event=event, status="Failed: REP_NAME_TAKEN",
-                                   message="Your representing name is already taken. Please choose another.",
-                                   user=user), 400
-
-        # Log event registration
-        public_data = {
-            "registered_time": math.floor(time()),
-            "role": role
-        }
-
-        # Check for event capacity if it is a team registration
-        if event.get("registered") and event["limit"] != -1 and len(event["registered"]) >= event[
-            "limit"] and role == "team" and not override:
-            return render_template("event/done.html.jinja", event=event, status="Failed: EVENT_FULL",
-                                   message="This event has reached maximum capacity for team registrations. You will need to contact the event owner.",
-                                   user=user), 400
-
-        db.add_entry(event_id, public_data, private_data, override)
-        return render_template("event/done.html.jinja", event=event, status="Registration successful",
-                               message="Your registration was successfully recorded. Go to the dashboard to view all your registered events, and remember to bring a smart device for QR code check-in on the day.",
-                               user=user)
-    else:
-        return render_template("event/register.html.jinja", event=event, user=user,
-                               mapbox_api_key=os.getenv("MAPBOX_API_KEY"))
+    return render_template("event/register.html.jinja", event=event, user=user,
+                           teams=db.get_counters(event_id)["teams"], mapbox_api_key=os.getenv("MAPBOX_API_KEY"))
 
 
 @events_bp.route("/events/unregister/<string:event_id>", methods=["GET", "POST"])
@@ -354,9 +297,9 @@ def event_unregister(event_id: str):
     """
         Unregister a user from an event.
     """
-    event = db.get_event(event_id)
+    event = db.get_event_meta(event_id)
     if request.method == "POST":
-        if not event.get("registered"):
+        if not event or not db.get_registration(event_id):
             return render_template("event/done.html.jinja", event=event, status="Failed: REGIS_NF",
                                    message="You are not registered for this event.",
                                    user=getattr(current_user, "data")), 400
@@ -366,11 +309,6 @@ def event_unregister(event_id: str):
                                    message="The currently logged in RoboRegistry account is the owner of this event. The owner cannot unregister from their own event.",
                                    user=getattr(current_user, "data")), 400
 
-        if utils.get_uid() not in event["registered"]:
-            return render_template("event/done.html.jinja", event=event, status="Failed: REGIS_NF",
-                                   message="You are not registered for this event.",
-                                   user=getattr(current_user, "data")), 400
-
         if db.unregister(event_id):
             return render_template("event/done.html.jinja", event=event, status="Unregistration successful",
                                    message="Your registration was successfully removed.",
@@ -392,22 +330,20 @@ def gen(event_id: str):
     """
         Generate a QR code for an event.
     """
-    event = db.get_event(event_id)
+    event = db.get_event_meta(event_id)
     if not event:
         abort(404)
 
     # Check if the event is done, reject if it is
-    tz = timezone(event["timezone"])
-    tz.localize(datetime.strptime(
-        event["date"] + event["start_time"], "%Y-%m-%d%H:%M"))
-    if tz.localize(datetime.strptime(event["date"] + event["end_time"], "%Y-%m-%d%H:%M")) < datetime.now(tz):
+    if utils.EventSchedule.of(event).ended():
         return render_template("event/done.html.jinja", event=event, status="Failed: QR_GEN_FAIL",
                                message="Unable to generate QR codes for an event that has ended, as registration and check-in links are no longer active.",
                                user=getattr(current_user, "data")), 400
-    if request.method == "POST":
+    if request.method == "POST" or "size" in request.args:
         # Interpret data
-        size = request.form.get("size")
-        qr_type = request.form.get("type")
+        source = request.form if request.method == "POST" else request.args
+        size = source.get("size")
+        qr_type = source.get("type")
         if not size or not qr_type:
             return render_template("event/gen.html.jinja", error="Please fill out all fields.", event=event,
                                    user=getattr(current_user, "data"))
@@ -419,13 +355,16 @@ def gen(event_id: str):
         if qr_type not in ("register", "ci"):
             return render_template("event/gen.html.jinja", error="Invalid QR code type.", event=event,
                                    user=getattr(current_user, "data"))
+        if request.method == "POST":
+            # Serve the image from a GET so the browser can revalidate it with the ETag
+            return redirect(f"/events/gen/qr/{event_id}?size={size}&type={qr_type}", 303)
         # Generate QR code based on input
         qrcode = img.generate_qrcode(event, size, qr_type)
         if not qrcode:
             return render_template("event/gen.html.jinja", error="An error occurred while generating the QR code.",
                                    event=event, user=getattr(current_user, "data"))
-        # Send file to user
-        return send_file(qrcode, mimetype="image/png")
+        # Send file to user, as a 304 if their copy has the same inputs
+        return send_file(qrcode, mimetype="image/png", etag=img.qrcode_key(event, size, qr_type), conditional=True)
     else:
         return render_template("event/gen.html.jinja", event=event, user=getattr(current_user, "data"))
 
@@ -439,19 +378,51 @@ def gen_ci(event_id: str):
         Generate a static version of check-in information for an event.
     """
     event = db.get_event(event_id)
-    bufs = img.generate_man_ci(event)
-    file = None
-    if len(bufs) > 1:
-        # Need to zip the files
-        stream = BytesIO()
-        with ZipFile(stream, "w") as zip:
-            for i, buf in enumerate(bufs):
-                zip.writestr(f"checkin_{i}.png", buf.getvalue())
-        stream.seek(0)
-        file = stream
-    else:
-        file = bufs[0]
-    return send_file(file, mimetype="image/png" if len(bufs) == 1 else "application/zip")
+    pages = img.get_man_ci_pages(event)
+    if request.args.get("format") == "pdf":
+        return send_file(img.render_man_ci_pdf(event, pages), mimetype="application/pdf",
+                         download_name=f"{event_id}-checkin.pdf")
+    rendered = img.render_man_ci(event, pages)
+    if len(pages) == 1:
+        return send_file(BytesIO(next(rendered)), mimetype="image/png")
+    # Need to zip the files, which are sent as each page finishes rendering
+    files = ((f"checkin_{i}.png", page) for i, page in enumerate(rendered))
+    return Response(_stream_zip(files), mimetype="application/zip",
+                    headers={"Content-Disposition": f"attachment; filename={event_id}-checkin.zip"})
+
+
+class _ZipStream(RawIOBase):
+    """
+        Unseekable sink for ZipFile that hands back what has been written so far.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def _stream_zip(files):
+    """
+        Build a ZIP archive incrementally from (name, data) pairs, yielding its bytes after every file is added.
+    """
+    stream = _ZipStream()
+    with ZipFile(stream, "w") as zip:
+        for name, data in files:
+            zip.writestr(name, data)
+            yield stream.drain()
+    # Central directory is written on close
+    yield stream.drain()
 
 
 @events_bp.route("/events/ci/<string:event_id>", methods=["GET", "POST"])
@@ -460,7 +431,7 @@ def checkin(event_id: str):
     """
         Check in to an event.
     """
-    event = db.get_event(event_id)
+    event = db.get_event_meta(event_id)
     if not event:
         abort(404)
 
@@ -494,7 +465,8 @@ def dynamic(event_id: str):
     """
         Check into an event using check in code approval.
     """
-    event = db.get_event(event_id)
+    # The page has no roster, as users search for themselves, and a check-in only reads its own registration
+    event = db.get_event_meta(event_id)
     if not event:
         abort(404)
 
@@ -509,36 +481,37 @@ def dynamic(event_id: str):
         # Send them back to the check-in page if they don't have a valid check-in code
         return redirect("/events/ci/" + event_id)
 
-    registered = []
-    if event.get("registered"):
-        for registration in event["registered"].values():
-            if registration.get("checkin_data").get("checked_in"):
-                continue
-            registered.append(registration["entity"])
-
     if request.method == "POST":
-        # Get the entity of which we are checking in
+        # Get the registration key of the entity of which we are checking in
         entity = request.form.get("entity")
 
-        # Validate an entity if it is not anonymous
-        if entity != "anon" and entity not in registered:
-            return render_template("event/done.html.jinja", event=event, status="Failed: CI_INVALID",
-                                   message="You have provided an invalid entity! If trouble persists, try registration email check-in or asking the event owner to record you as attended manually.",
-                                   user=getattr(current_user, "data", db.logged_out_data)), 400
+        if entity and entity != "anon":
+            # Pages rendered before registration keys were used will post the entity string instead,
+            # which has the structure of '{CONTACTNAME} | {REPNAME}' and is found through the names index
+            legacy = " | " in entity
+            key = db.get_uid_for_entity(event_id, entity) if legacy else entity
+            registration = db.get_registration(event_id, key) if utils.is_key(key) else {}
 
-        if entity != "anon" and len(registered) == 0:
-            # This should be impossible
-            abort(418)
+            # Validate an entity if it is not anonymous
+            if not registration.get("entity") or (legacy and registration["entity"] != entity):
+                return render_template("event/done.html.jinja", event=event, status="Failed: CI_INVALID",
+                                       message="You have provided an invalid entity! If trouble persists, try registration email check-in or asking the event owner to record you as attended manually.",
+                                       user=getattr(current_user, "data", db.logged_out_data)), 400
+            if registration.get("checkin_data", {}).get("checked_in"):
+                return render_template("event/done.html.jinja", event=event, status="Failed: CI_ALR",
+                                       message="You have already been checked in to this event.",
+                                       user=getattr(current_user, "data", db.logged_out_data)), 400
+            entity = key
 
         # Otherwise the user would have to provide a basic affiliation
         anon_affil = request.form.get("visit-reason")
         anon_name = request.form.get("anon-name")
 
-        if not entity or (entity == "anon" and not anon_affil or not anon_name):
+        if not entity or (entity == "anon" and (not anon_affil or not anon_name)):
             return render_template("event/done.html.jinja", event=event, status="Failed: CI_INVALID",
                                    message="You have provided insufficient data! If trouble persists, try registration email check-in or asking the event owner to record you as attended manually.",
                                    user=getattr(current_user, "data", db.logged_out_data)), 400
-        if anon_affil:
+        if entity == "anon":
             # Ensure visit-reason is in (noregis, public, visitor, manager, other)
             if anon_affil not in ("noregis", "public", "visitor", "manager", "other"):
                 return render_template("event/done.html.jinja", event=event, status="Failed: CI_INVALID",
@@ -549,7 +522,7 @@ def dynamic(event_id: str):
             db.anon_check_in(event_id, anon_affil, anon_name)
         else:
             # Normal user check-in
-            db.dyn_check_in(event_id, entity)
+            db.check_in(event_id, entity)
 
         session["checkin"] = None
 
@@ -557,7 +530,32 @@ def dynamic(event_id: str):
                                message="Your check in has been recorded successfully by dynamic self check-in. You can safely close this tab.",
                                user=getattr(current_user, "data", db.logged_out_data))
     else:
-        return render_template("event/checkin.html.jinja", event=event, registered=registered)
+        return render_template("event/checkin.html.jinja", event=event)
+
+
+@events_bp.route("/events/ci/<string:event_id>/search")
+@event_must_be_running(json=True)
+def search(event_id: str):
+    """
+        Search the registrations yet to check in to an event by name, for the dynamic check-in page.
+        Requires the same check-in code approval as dynamic check-in, and is only served while the event is running.
+    """
+    event = db.get_event_meta(event_id)
+    if not event:
+        return {
+            "error": "NOT_FOUND"
+        }, 404
+
+    code = session.get("checkin")
+    if not code or code != event.get("checkin_code"):
+        return {
+            "error": "CI_INVALID"
+        }, 403
+
+    limit = min(request.args.get("limit", roster.ROSTER_SEARCH_LIMIT, type=int), roster.ROSTER_SEARCH_MAX)
+    return {
+        "results": roster.search(event_id, request.args.get("q", ""), limit)
+    }
 
 
 @events_bp.route("/events/ci/<string:event_id>/manual", methods=["GET", "POST"])
@@ -568,7 +566,7 @@ def manual(event_id: str):
     """
         Check in to an event using email associated with registration.
     """
-    event = db.get_event(event_id)
+    event = db.get_event_meta(event_id)
 
     # Stop check-in if the event check-in is disabled
     if not event["settings"]["checkin"]:
@@ -576,12 +574,12 @@ def manual(event_id: str):
                                message="Check-in for this event has been disabled by the event owner.",
                                user=getattr(current_user, "data", db.logged_out_data)), 400
 
-    registered, owned = db.get_my_events()
-    if event_id in owned.keys():
+    if event["creator"] == utils.get_uid():
         return render_template("event/done.html.jinja", event=event, status="Failed: EVENT_OWNER",
                                message="The currently logged in RoboRegistry account is the owner of this event. The owner cannot check in to their own event.",
                                user=getattr(current_user, "data")), 400
-    if event_id not in registered.keys():
+    registration = db.get_registration(event_id)
+    if not registration:
         return render_template("event/done.html.jinja", event=event, status="Failed: NO_AFFIL",
                                message="The currently logged in RoboRegistry account has not registered for this event. The event owner will have to manually record your presence through their Dashboard.",
                                user=getattr(current_user, "data")), 400
@@ -593,7 +591,7 @@ def manual(event_id: str):
                                user=getattr(current_user, "data"))
     else:
         return render_template("event/manual.html.jinja", event=event, user=getattr(current_user, "data"),
-                               entity=registered[event_id]["registered"][utils.get_uid()]["entity"])
+                               entity=registration["entity"])
 
 
 @events_bp.route("/events/ci", methods=["GET", "POST"])
@@ -617,21 +615,25 @@ def ci():
 @login_required
 @validate_user
 @must_be_event_owner
+@conditional(_manage_version)
 def manage(event_id: str):
     """
         Manage and view an event's data.
     """
-    event = db.get_event(event_id)
     try:
-        data = db.get_event_data(event_id)
+        event, data = db.fan_out(lambda: db.get_event_meta(event_id), lambda: db.get_event_data(event_id))
     except HTTPError:
         abort(403)
 
+    # Events created before the registration indexes were kept need them built once
+    if event.get("index_version") != db.EVENT_INDEX_VERSION:
+        db.migrate_event_index(event_id)
+
     # Calculate the UTC offset for the event, to display time correctly
-    offset = timezone(event["timezone"]).utcoffset(datetime.now()).total_seconds() / 3600
+    offset = utils.EventSchedule.of(event).utc_offset
 
     return render_template("event/manage.html.jinja", event=event, data=data, user=getattr(current_user, "data"),
-                           offset=offset)
+                           offset=offset, streaming=api.REGISTRATION_STREAMING)
 
 
 @events_bp.route("/events/manage/<string:event_id>/driver")
@@ -642,7 +644,9 @@ def driver(event_id: str):
     """
         Check-in driver for the event owner.
     """
-    event = db.get_event(event_id)
+    event = db.get_event_meta(event_id)
+    # The booth checks users in with a kiosk token, as it will no longer be logged in
+    token = kiosk.issue_token(event)
     # Establish a secure environment by logging out
     logout_user()
-    return render_template("event/driver.html.jinja", event=event)
+    return render_template("event/driver.html.jinja", event=event, token=token)
@@ -4,8 +4,23 @@
 """
 
 import os
+import threading
 
 import firebase
+from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# Connections kept open to each Firebase host, which should be at least the number of threads serving requests
+POOL_SIZE = int(os.getenv("FIREBASE_POOL_SIZE", 16))
+# Seconds to wait for a connection to Firebase, and for each read of a response
+TIMEOUT = (float(os.getenv("FIREBASE_CONNECT_TIMEOUT", 3.05)), float(os.getenv("FIREBASE_READ_TIMEOUT", 20)))
+# Failed connections are always retried, but only idempotent requests are retried after being sent
+# PUT is left out, as a conditional write that was applied before its response was lost would be refused when retried,
+# and writes such as increments are sent with PATCH, which is never retried after being sent
+RETRY = Retry(total=3, connect=3, read=2, status=3, backoff_factor=0.25,
+              allowed_methods=frozenset({"GET", "HEAD", "OPTIONS", "DELETE"}),
+              status_forcelist=(429, 500, 502, 503, 504), raise_on_status=False)
 
 config = {
     # Firebase API key is stored in the environment variables for security reasons
@@ -33,6 +48,68 @@ oauth_config = {
     }
 }
 
+
+class PooledSession(Session):
+    """
+        A session for all Firebase REST requests, which keeps connections alive and applies a default timeout.
+        Safe to share between threads, as only the connection pool is mutated by requests.
+    """
+
+    def __init__(self):
+        super().__init__()
+        # Firebase traffic goes to the database and a handful of Google authentication hosts
+        self.adapter = HTTPAdapter(pool_connections=8, pool_maxsize=POOL_SIZE, max_retries=RETRY)
+        self.mount("https://", self.adapter)
+        self.mount("http://", self.adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        # The Firebase client never sets a timeout, so requests could otherwise hang a worker indefinitely
+        kwargs.setdefault("timeout", TIMEOUT)
+        return super().request(method, url, *args, **kwargs)
+
+    def pool_stats(self) -> dict:
+        """
+            Usage of the connection pool for each host this process has connected to.
+            A host with connections_opened well above max_size has more concurrent requests than the pool allows,
+            and connections beyond max_size are closed after use instead of being kept alive.
+        """
+        pools = self.adapter.poolmanager.pools
+        stats = {}
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None or pool.pool is None:
+                continue
+            stats[pool.host] = {
+                "max_size": pool.pool.maxsize,
+                "in_use": pool.pool.maxsize - pool.pool.qsize(),
+                "idle": sum(conn is not None for conn in list(pool.pool.queue)),
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests
+            }
+        return stats
+
+
+class ThreadLocalDatabase:
+    """
+        The Firebase database client builds paths with child() on the client itself, so it cannot be shared by threads.
+        Attributes are looked up on a client created for the current thread, which all share the same session.
+    """
+
+    def __init__(self, app):
+        self._app = app
+        self._local = threading.local()
+
+    def __getattr__(self, name):
+        database = getattr(self._local, "database", None)
+        if database is None:
+            database = self._local.database = self._app.database()
+        return getattr(database, name)
+
+
+session = PooledSession()
+
 fb_instance = firebase.initialize_app(config)
+# Replace the default session before creating services, which each keep a reference to it
+fb_instance.requests = session
 auth = fb_instance.auth(client_secret=oauth_config)
-db = fb_instance.database()
+db = ThreadLocalDatabase(fb_instance)
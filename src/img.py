@@ -3,22 +3,158 @@
     @author: Lucas Bubner
 """
 
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from io import BytesIO
+from typing import Iterator
 
 import qrcode
 import qrcode.constants
 from PIL import Image, ImageDraw, ImageFont, ImageOps
+from cachetools import LRUCache
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
 from flask import abort
 from pytz import timezone
 from requests.exceptions import HTTPError
 
 import db
 
+# Bump when the QR code layout changes, so previously cached images are not served
+QR_RENDER_VERSION = 1
+
+# Event fields that affect a generated QR code image
+QR_EVENT_FIELDS = ("uid", "name", "date", "start_time", "end_time", "location", "email", "checkin_code")
+
+# Generated QR code images, bounded by their total size in bytes
+_qr_cache = LRUCache(maxsize=int(os.getenv("QR_CACHE_BYTES", 64 * 1024 * 1024)), getsizeof=len)
+_qr_cache_lock = threading.Lock()
+
+# Optional local directory to also keep generated QR codes in, bounded by the number of files
+QR_CACHE_DIR = os.getenv("QR_CACHE_DIR")
+QR_CACHE_DIR_FILES = int(os.getenv("QR_CACHE_DIR_FILES", 512))
+
+# Maximum registrations per manual check-in page due to size
+MAN_CI_PAGE_SIZE = 25
+
+# Manual check-in sheets are laid out on A4 paper at 300 DPI
+MAN_CI_PAGE_PX = (2480, 3508)
+
+# Pool used to render manual check-in pages concurrently, either "thread" or "process"
+MAN_CI_POOL = os.getenv("MAN_CI_POOL", "thread")
+MAN_CI_WORKERS = int(os.getenv("MAN_CI_WORKERS", min(4, os.cpu_count() or 1)))
+_man_ci_executor = None
+_man_ci_executor_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def _font(name, size) -> ImageFont.FreeTypeFont:
+    """
+        Load a font from the static assets, once per font and size.
+    """
+    return ImageFont.truetype(f"static/assets/{name}", size)
+
+
+@lru_cache(maxsize=None)
+def _asset(name, scale=1.0) -> Image.Image:
+    """
+        Load and decode an image from the static assets once, optionally scaled.
+        The returned image is shared and must not be drawn on, use _template for a copy.
+    """
+    image = Image.open(f"static/assets/{name}")
+    image.load()
+    if scale != 1.0:
+        image = image.resize((int(image.size[0] * scale), int(image.size[1] * scale)))
+    return image
+
+
+def _template(name) -> Image.Image:
+    """
+        Get a copy of an image asset that is safe to composite onto.
+    """
+    return _asset(name).copy()
+
+
+def qrcode_key(event, size, qr_type) -> str:
+    """
+        Hash every input that affects a generated QR code image.
+        Used as both the cache key and the ETag of the image.
+    """
+    inputs = [QR_RENDER_VERSION, size, qr_type] + [event.get(field) for field in QR_EVENT_FIELDS]
+    return hashlib.sha256(json.dumps(inputs, default=str).encode()).hexdigest()
+
+
+def _read_cached_qrcode(key) -> bytes | None:
+    """
+        Find a generated QR code in the memory cache, then the disk cache if enabled.
+    """
+    with _qr_cache_lock:
+        data = _qr_cache.get(key)
+    if data is not None or not QR_CACHE_DIR:
+        return data
+    path = os.path.join(QR_CACHE_DIR, f"{key}.png")
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+        # Mark the file as recently used so it is pruned last
+        os.utime(path)
+    except OSError:
+        return None
+    with _qr_cache_lock:
+        _qr_cache[key] = data
+    return data
+
+
+def _write_cached_qrcode(key, data: bytes) -> None:
+    """
+        Store a generated QR code in the memory cache, and the disk cache if enabled.
+    """
+    with _qr_cache_lock:
+        _qr_cache[key] = data
+    if not QR_CACHE_DIR:
+        return
+    try:
+        os.makedirs(QR_CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first so other workers never read a partial image
+        tmp = os.path.join(QR_CACHE_DIR, f"{key}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, os.path.join(QR_CACHE_DIR, f"{key}.png"))
+        # Remove the least recently used files over the limit
+        files = [entry for entry in os.scandir(QR_CACHE_DIR) if entry.name.endswith(".png")]
+        if len(files) > QR_CACHE_DIR_FILES:
+            files.sort(key=lambda entry: entry.stat().st_mtime)
+            for entry in files[:len(files) - QR_CACHE_DIR_FILES]:
+                os.remove(entry.path)
+    except OSError:
+        # The disk cache is best effort, the image is still held in memory
+        pass
+
 
 def generate_qrcode(event, size, qr_type) -> BytesIO:
     """
-        Generates a QR code for RoboRegistry registration or check-in
+        Generates a QR code for RoboRegistry registration or check-in, reusing a cached image where possible
+        @return: QR code image as a BytesIO object
+    """
+    key = qrcode_key(event, size, qr_type)
+    data = _read_cached_qrcode(key)
+    if data is None:
+        data = _render_qrcode(event, size, qr_type).getvalue()
+        _write_cached_qrcode(key, data)
+    return BytesIO(data)
+
+
+def _render_qrcode(event, size, qr_type) -> BytesIO:
+    """
+        Draws a QR code for RoboRegistry registration or check-in
         @return: QR code image as a BytesIO object
     """
     img = qrcode.make(
@@ -31,9 +167,9 @@ def generate_qrcode(event, size, qr_type) -> BytesIO:
 
     # Open the RoboRegistry template depending on size and type
     if size == "large" and qr_type == "register":
-        template = Image.open("static/assets/rr_qr_template_large_register.png")
+        template = _template("rr_qr_template_large_register.png")
     elif size == "large" and qr_type == "ci":
-        template = Image.open("static/assets/rr_qr_template_large_checkin.png")
+        template = _template("rr_qr_template_large_checkin.png")
     else:
         # Make a fresh template for small QR codes
         template = Image.new("RGB", (img.size[0] + 20, img.size[1] + 20), color="white")
@@ -53,10 +189,10 @@ def generate_qrcode(event, size, qr_type) -> BytesIO:
     if size == "large":
         # Add text using PIL library
         draw = ImageDraw.Draw(template)
-        smallfont = ImageFont.truetype("static/assets/Roboto-Regular.ttf", 36)
-        font = ImageFont.truetype("static/assets/Roboto-Regular.ttf", 54)
-        boldfont = ImageFont.truetype("static/assets/Roboto-Black.ttf", 54)
-        bigfont = ImageFont.truetype("static/assets/Roboto-Black.ttf", 140)
+        smallfont = _font("Roboto-Regular.ttf", 36)
+        font = _font("Roboto-Regular.ttf", 54)
+        boldfont = _font("Roboto-Black.ttf", 54)
+        bigfont = _font("Roboto-Black.ttf", 140)
 
         # Add URL
         text = f"https://roboregistry.vercel.app/events/{qr_type}/{event.get('uid')}"
@@ -104,10 +240,10 @@ def generate_qrcode(event, size, qr_type) -> BytesIO:
     return img_file
 
 
-def generate_man_ci(event):
+def get_man_ci_pages(event) -> list[list[tuple[str, str]]]:
     """
-        Generate an A4 paper sheet with checkboxes for manual check-in
-        @returns Array of BytesIO objects for all pages needed
+        Collect the registrations for an event's manual check-in sheet, sorted by time
+        @returns A list of (name, affiliation) tuples for every page needed
     """
     try:
         data = db.get_event_data(event.get("uid"))
@@ -138,99 +274,184 @@ def generate_man_ci(event):
                 name = name[:24] + "..."
             entities[i] = (name, affil)
 
-    def _queue(entities) -> BytesIO:
-        """
-            Process one page of entities
-        """
-        # Make an A4 paper sheet
-        template = Image.new("RGB", (2480, 3508), color="white")
+    pages = [entities[i:i + MAN_CI_PAGE_SIZE] for i in range(0, len(entities), MAN_CI_PAGE_SIZE)]
 
-        # Write the event name
-        draw = ImageDraw.Draw(template)
-        font = ImageFont.truetype("static/assets/Roboto-Black.ttf", 60)
-        text = event.get("name").upper()
-        draw.text((100, 150), text, (0, 0, 0), font=font)
-
-        # Horizontal rule
-        draw.line((100, 300, 2380, 300), fill=(0, 0, 0), width=5)
-
-        # RoboRegistry logo in the top right
-        logo = Image.open("static/assets/rr.png")
-        logo = logo.resize((int(logo.size[0] * 0.5), int(logo.size[1] * 0.5)))
-        template.paste(logo, (2000, 100), logo)
-
-        # For every entity, write their name and affilliation
-        font = ImageFont.truetype("static/assets/Roboto-Regular.ttf", 40)
-        boldfont = ImageFont.truetype("static/assets/Roboto-Black.ttf", 40)
-
-        # Draw header
-        draw.text((100, 360), "All RoboRegistry registrations", (0, 0, 0), font=boldfont)
-
-        # Draw time of printing in the timezone of the event
-        current_localised_time = datetime.now(timezone(event.get("timezone"))).strftime("%Y-%m-%d %I:%M %p %Z")
-        text = "as of " + current_localised_time.strip()
-        draw.text((100, 420), text, (0, 0, 0), font=font)
-
-        maxlen = len(text) // 1.2
-        for i, entity in enumerate(entities):
-            # Draw a checkbox
-            draw.rectangle((100, 500 + i * 120, 150, 550 + i * 120), fill=(255, 255, 255), outline=(0, 0, 0), width=5)
-            # Draw the name
-            text = entity[0]
-            # Calculate the longest name
-            maxlen = len(text) if len(text) > maxlen else maxlen
-            draw.text((200, 500 + i * 120), text, (0, 0, 0), font=boldfont)
-            # Draw the affilliation under the name
-            text = entity[1]
-            maxlen = len(text) if len(text) > maxlen else maxlen
-            draw.text((200, 500 + i * 120 + 50), text, (0, 0, 0), font=font)
-
-        # Draw a vertical line to separate the registered from the extra walk-ins, using maxlen to calculate the position
-        draw.line((100 + 200 + maxlen * 20, 300, 100 + 200 + maxlen * 20, 3508), fill=(0, 0, 0), width=5)
-
-        # Draw a table header for the extra walk-ins, with the values Name, Affiliation, and Time
-        font = ImageFont.truetype("static/assets/Roboto-Black.ttf", 40)
-        draw.text((100 + 200 + maxlen * 20 + 100 + (500 - font.getbbox("Name")[2]) // 2, 400), "Name", (0, 0, 0),
-                  font=font)
-        draw.text((100 + 200 + maxlen * 20 + 100 + 500 + (500 - font.getbbox("Affiliation")[2]) // 2, 400),
-                  "Affiliation", (0, 0, 0), font=font)
-        draw.text((100 + 200 + maxlen * 20 + 100 + 500 + 500 + (500 - font.getbbox("Time")[2]) // 2, 400), "Time",
-                  (0, 0, 0), font=font)
-
-        # Draw table cells
-        font = ImageFont.truetype("static/assets/Roboto-Regular.ttf", 40)
-        for i in range(30):
-            draw.line((100 + 200 + maxlen * 20 + 100, 500 + i * 100, template.width - 100, 500 + i * 100),
-                      fill=(0, 0, 0), width=3)
-            # Make vertical lines that seperate the columns
-            draw.line((100 + 200 + maxlen * 20 + 100 + 500, 400, 100 + 200 + maxlen * 20 + 100 + 500, 3508),
-                      fill=(0, 0, 0), width=3)
-            draw.line((100 + 200 + maxlen * 20 + 100 + 500 + 500, 400, 100 + 200 + maxlen * 20 + 100 + 500 + 500, 3508),
-                      fill=(0, 0, 0), width=3)
-            draw.line((100 + 200 + maxlen * 20 + 100 + 500 + 500 + 500, 400,
-                       100 + 200 + maxlen * 20 + 100 + 500 + 500 + 500, 3508),
-                      fill=(0, 0, 0), width=3)
-
-        buf = BytesIO()
-        template.save(buf, "PNG")
-        buf.seek(0)
-
-        return buf
-
-    bufs = []
-
-    # Maximum 25 per page due to size
-    if len(entities) > 0:
-        while len(entities) > 25:
-            # Get registrations that are not on this page
-            left = entities[25:]
-            bufs.append(_queue(entities[:25]))
-            entities = left
-        # Queue the remaining registrations
-        bufs.append(_queue(entities))
-
-    if len(bufs) == 0:
-        # If there are no registrations, just queue an empty page
-        bufs.append(_queue([]))
-
-    return bufs
+    # If there are no registrations, just queue an empty page
+    return pages or [[]]
+
+
+def render_man_ci(event, pages) -> Iterator[bytes]:
+    """
+        Render the pages of a manual check-in sheet concurrently
+        @returns PNG data for each page, yielded in order as they finish
+    """
+    executor = _get_man_ci_executor()
+    futures = [executor.submit(_render_man_ci_page, event.get("name"), event.get("timezone"), page) for page in pages]
+    try:
+        for future in futures:
+            yield future.result()
+    finally:
+        # Don't render the rest if the consumer has gone away
+        for future in futures:
+            future.cancel()
+
+
+def _get_man_ci_executor() -> Executor:
+    """
+        Get the worker pool used for rendering manual check-in pages, creating it on first use.
+    """
+    global _man_ci_executor
+    with _man_ci_executor_lock:
+        if _man_ci_executor is None:
+            if MAN_CI_POOL == "process":
+                _man_ci_executor = ProcessPoolExecutor(max_workers=MAN_CI_WORKERS)
+            else:
+                _man_ci_executor = ThreadPoolExecutor(max_workers=MAN_CI_WORKERS, thread_name_prefix="man_ci")
+        return _man_ci_executor
+
+
+def _man_ci_layout(event_name, printed_time, entities) -> list[tuple]:
+    """
+        Lay out one A4 manual check-in sheet in pixels at 300 DPI, measured from the top left.
+        Shared by the PNG and PDF renderers so both produce the same sheet.
+        @return: Drawing operations of ("text", (x, y), text, font, size), ("line", (x1, y1, x2, y2), width),
+                 ("rect", (x1, y1, x2, y2), width) and ("logo", (x, y))
+    """
+    ops = []
+    width, height = MAN_CI_PAGE_PX
+
+    # Write the event name
+    ops.append(("text", (100, 150), event_name.upper(), "Roboto-Black.ttf", 60))
+
+    # Horizontal rule
+    ops.append(("line", (100, 300, 2380, 300), 5))
+
+    # RoboRegistry logo in the top right
+    ops.append(("logo", (2000, 100)))
+
+    # Draw header
+    ops.append(("text", (100, 360), "All RoboRegistry registrations", "Roboto-Black.ttf", 40))
+
+    # Draw time of printing in the timezone of the event
+    text = "as of " + printed_time.strip()
+    ops.append(("text", (100, 420), text, "Roboto-Regular.ttf", 40))
+
+    # For every entity, write their name and affilliation
+    maxlen = len(text) // 1.2
+    for i, entity in enumerate(entities):
+        # Draw a checkbox
+        ops.append(("rect", (100, 500 + i * 120, 150, 550 + i * 120), 5))
+        # Draw the name
+        text = entity[0]
+        # Calculate the longest name
+        maxlen = len(text) if len(text) > maxlen else maxlen
+        ops.append(("text", (200, 500 + i * 120), text, "Roboto-Black.ttf", 40))
+        # Draw the affilliation under the name
+        text = entity[1]
+        maxlen = len(text) if len(text) > maxlen else maxlen
+        ops.append(("text", (200, 500 + i * 120 + 50), text, "Roboto-Regular.ttf", 40))
+
+    # Draw a vertical line to separate the registered from the extra walk-ins, using maxlen to calculate the position
+    ops.append(("line", (100 + 200 + maxlen * 20, 300, 100 + 200 + maxlen * 20, height), 5))
+
+    # Draw a table header for the extra walk-ins, with the values Name, Affiliation, and Time
+    table_x = 100 + 200 + maxlen * 20 + 100
+    font = _font("Roboto-Black.ttf", 40)
+    for column, text in enumerate(("Name", "Affiliation", "Time")):
+        ops.append(("text", (table_x + column * 500 + (500 - font.getbbox(text)[2]) // 2, 400), text,
+                    "Roboto-Black.ttf", 40))
+
+    # Draw table cells
+    for i in range(30):
+        ops.append(("line", (table_x, 500 + i * 100, width - 100, 500 + i * 100), 3))
+    # Make vertical lines that seperate the columns
+    for column in range(1, 4):
+        ops.append(("line", (table_x + column * 500, 400, table_x + column * 500, height), 3))
+
+    return ops
+
+
+def _render_man_ci_page(event_name, event_timezone, entities) -> bytes:
+    """
+        Generate one A4 paper sheet with checkboxes for manual check-in
+        Takes only plain values so it can run in a worker process
+    """
+    # Make an A4 paper sheet
+    template = Image.new("RGB", MAN_CI_PAGE_PX, color="white")
+    draw = ImageDraw.Draw(template)
+
+    printed_time = datetime.now(timezone(event_timezone)).strftime("%Y-%m-%d %I:%M %p %Z")
+    for op in _man_ci_layout(event_name, printed_time, entities):
+        if op[0] == "text":
+            draw.text(op[1], op[2], (0, 0, 0), font=_font(op[3], op[4]))
+        elif op[0] == "line":
+            draw.line(op[1], fill=(0, 0, 0), width=op[2])
+        elif op[0] == "rect":
+            draw.rectangle(op[1], fill=(255, 255, 255), outline=(0, 0, 0), width=op[2])
+        elif op[0] == "logo":
+            logo = _asset("rr.png", 0.5)
+            template.paste(logo, op[1], logo)
+
+    buf = BytesIO()
+    template.save(buf, "PNG")
+    return buf.getvalue()
+
+
+def render_man_ci_pdf(event, pages) -> BytesIO:
+    """
+        Draw a manual check-in sheet as one multi-page vector PDF, with the same layout as the PNG pages
+        @return: PDF document as a BytesIO object
+    """
+    _register_pdf_fonts()
+    buf = BytesIO()
+    pdf = canvas.Canvas(buf, pagesize=A4)
+    pdf.setTitle(f"{event.get('name')} check-in sheet")
+
+    # Convert from layout pixels measured from the top left, to PDF points measured from the bottom left
+    scale = A4[0] / MAN_CI_PAGE_PX[0]
+
+    def _x(px):
+        return px * scale
+
+    def _y(px):
+        return A4[1] - px * scale
+
+    logo = _asset("rr.png", 0.5)
+    logo_reader = ImageReader(logo)
+    printed_time = datetime.now(timezone(event.get("timezone"))).strftime("%Y-%m-%d %I:%M %p %Z")
+    for entities in pages:
+        for op in _man_ci_layout(event.get("name"), printed_time, entities):
+            if op[0] == "text":
+                (x, y), text, font, size = op[1:]
+                # Text is positioned by its ascender in the layout, but by its baseline in a PDF
+                ascent = _font(font, size).getmetrics()[0]
+                pdf.setFont(font, size * scale)
+                pdf.drawString(_x(x), _y(y + ascent), text)
+            elif op[0] == "line":
+                (x1, y1, x2, y2), width = op[1:]
+                pdf.setLineWidth(width * scale)
+                pdf.line(_x(x1), _y(y1), _x(x2), _y(y2))
+            elif op[0] == "rect":
+                (x1, y1, x2, y2), width = op[1:]
+                # Outlines are drawn inside the box in the layout, but centred on its edge in a PDF
+                inset = width / 2
+                pdf.setLineWidth(width * scale)
+                pdf.rect(_x(x1 + inset), _y(y2 - inset), (x2 - x1 - width) * scale, (y2 - y1 - width) * scale)
+            elif op[0] == "logo":
+                x, y = op[1]
+                pdf.drawImage(logo_reader, _x(x), _y(y + logo.size[1]), logo.size[0] * scale, logo.size[1] * scale,
+                              mask="auto")
+        pdf.showPage()
+
+    pdf.save()
+    buf.seek(0)
+    return buf
+
+
+@lru_cache(maxsize=None)
+def _register_pdf_fonts() -> None:
+    """
+        Register the Roboto fonts for embedding into PDFs, once per process.
+    """
+    for name in ("Roboto-Regular.ttf", "Roboto-Black.ttf"):
+        pdfmetrics.registerFont(TTFont(name, f"static/assets/{name}"))
@@ -0,0 +1,278 @@
+"""
+    Check-in API for self check-in kiosks in RoboRegistry
+    Kiosks are logged out for security, so they are authorised by a kiosk token scoped to one event instead.
+    @author: Lucas Bubner, 2023
+"""
+
+import math
+import os
+import re
+import uuid
+from datetime import datetime
+from functools import wraps
+from time import time
+
+from flask import Blueprint, current_app, request
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from pytz import utc
+
+import db
+import utils
+
+kiosk_bp = Blueprint("kiosk", __name__)
+
+# Seconds a kiosk token is valid for, long enough to run a booth for an event day
+KIOSK_TOKEN_TTL = int(os.getenv("KIOSK_TOKEN_TTL", 12 * 60 * 60))
+
+# Most check-ins a kiosk may send in one batch
+KIOSK_BATCH_LIMIT = 100
+
+# Reasons an anonymous user may give for checking in
+ANON_AFFILS = ("noregis", "public", "visitor", "manager", "other")
+
+# Ids kiosks give their check-ins, which must be usable as a database key
+_CHECK_IN_ID = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+@kiosk_bp.route("/kiosk_sw.js")
+def service_worker():
+    """
+        Serves the kiosk service worker from the root, so it can control the booth page.
+    """
+    res = current_app.send_static_file("kiosk_sw.js")
+    # Browsers check for service worker updates on every visit
+    res.headers["Cache-Control"] = "no-cache"
+    return res
+
+
+def _serializer(secret_key=None) -> URLSafeTimedSerializer:
+    """
+        Get the serializer that signs kiosk tokens with the app's secret key.
+        secret_key is given where there is no Flask app context, such as under ASGI.
+    """
+    return URLSafeTimedSerializer(secret_key or current_app.secret_key, salt="kiosk")
+
+
+def issue_token(event) -> str:
+    """
+        Issue a kiosk token for an event, which must only be given out by the event owner.
+        The token is bound to the event's check-in code, so changing the code revokes it.
+    """
+    return _serializer().dumps({"event": event["uid"], "code": str(event["checkin_code"])})
+
+
+def _error(code, status):
+    """
+        Build a JSON error response.
+    """
+    return {
+        "error": code
+    }, status
+
+
+def read_token(authorization, secret_key=None) -> dict | None:
+    """
+        Read the claims of a kiosk token, given in an Authorization header as "Bearer <token>".
+        @return: The claims, or None if the token is missing, invalid or expired
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        return _serializer(secret_key).loads(token, max_age=KIOSK_TOKEN_TTL)
+    except BadSignature:
+        # Includes tokens that have expired
+        return None
+
+
+def refusal(claims, event_id, event) -> tuple | None:
+    """
+        Find why a kiosk may not check in to an event, from its token claims and the event's metadata.
+        @return: A JSON error response, or None if the kiosk may check in
+    """
+    if claims is None:
+        return _error("KIOSK_TOKEN_INVALID", 401)
+    if not event:
+        return _error("NOT_FOUND", 404)
+    if claims.get("event") != event_id or claims.get("code") != str(event["checkin_code"]):
+        return _error("KIOSK_TOKEN_INVALID", 401)
+    if not event["settings"]["checkin"]:
+        return _error("CI_DISABLED", 400)
+    return None
+
+
+def kiosk_required(f):
+    """
+        Ensure a request carries a valid kiosk token for the event, given as "Authorization: Bearer <token>".
+        The route is called with the event's metadata, and is refused if check-ins have been disabled.
+    """
+
+    @wraps(f)
+    def check(event_id, *args, **kwargs):
+        # The token is checked before anything is read, so invalid tokens cost nothing
+        if not (claims := read_token(request.headers.get("Authorization"))):
+            return _error("KIOSK_TOKEN_INVALID", 401)
+        event = db.get_event_meta(event_id)
+        if res := refusal(claims, event_id, event):
+            return res
+        return f(event, *args, **kwargs)
+
+    return check
+
+
+@kiosk_bp.route("/api/kiosk/<string:event_id>/roster")
+@kiosk_required
+def roster(event):
+    """
+        Returns the registration keys mapped to their entity, for those not yet checked in.
+        Kiosks fetch this once and keep it up to date from their own check-ins.
+    """
+    if not utils.EventSchedule.of(event).checkin_open():
+        return _error("EVENT_NOT_RUNNING", 400)
+    registered = {}
+    for key, data in (db.get_event(event["uid"]).get("registered") or {}).items():
+        if data.get("checkin_data", {}).get("checked_in"):
+            continue
+        registered[key] = data["entity"]
+    return {
+        "registered": registered
+    }
+
+
+@kiosk_bp.route("/api/kiosk/<string:event_id>/checkin", methods=["POST"])
+@kiosk_required
+def checkin(event):
+    """
+        Check in a registration or an anonymous user.
+        The JSON body is {"entity": key} for a registration, or {"entity": "anon", "visit_reason": ..., "name": ...}.
+        It may also have an "id", so the same check-in can be replayed through /batch if the response is lost.
+    """
+    now = math.floor(time())
+    items = checkin_items(request.get_json(silent=True), now)
+    if not isinstance(items, list):
+        return items
+    return checkin_response(_apply(event, items, now), items)
+
+
+@kiosk_bp.route("/api/kiosk/<string:event_id>/batch", methods=["POST"])
+@kiosk_required
+def batch(event):
+    """
+        Apply check-ins recorded by a kiosk while it was offline, in one write.
+        The JSON body is {"checkins": [...]}, where each check-in is the same as for /checkin with an "id" that is
+        unique to it and the "time" it was made. Sending the same check-in again has no further effect.
+        @return: {"results": {id: "CHECKED_IN" or an error code}}, where every result is final
+    """
+    items = batch_items(request.get_json(silent=True))
+    if not isinstance(items, list):
+        return items
+    return {
+        "results": _apply(event, items, math.floor(time()))
+    }
+
+
+def checkin_items(body, now) -> list | tuple:
+    """
+        Read the check-in sent to /checkin as a one item batch.
+        @return: The items, or a JSON error response if the body is invalid
+    """
+    if not isinstance(body, dict):
+        return _error("CI_INVALID", 400)
+    # Check-ins made online happen now, whatever time the kiosk gave
+    return [body | {"id": body.get("id") or uuid.uuid4().hex, "time": now}]
+
+
+def checkin_response(results, items) -> dict | tuple:
+    """
+        Build the response to /checkin from the result of its one item batch.
+    """
+    result = results.get(items[0]["id"], "CI_INVALID")
+    if result != "CHECKED_IN":
+        return _error(result, 409 if result == "CI_ALR" else 400)
+    return {
+        "status": result
+    }
+
+
+def batch_items(body) -> list | tuple:
+    """
+        Read the check-ins sent to /batch.
+        @return: The items, or a JSON error response if the body is invalid
+    """
+    items = body.get("checkins") if isinstance(body, dict) else None
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        return _error("CI_INVALID", 400)
+    if len(items) > KIOSK_BATCH_LIMIT:
+        return _error("BATCH_TOO_LARGE", 413)
+    return items
+
+
+def registration_keys(items) -> list:
+    """
+        Find the registrations a batch of check-ins needs to read, rather than the whole roster.
+    """
+    return list({item["entity"] for item in items if utils.is_key(item.get("entity")) and item["entity"] != "anon"})
+
+
+def _apply(event, items, now) -> dict:
+    """
+        Validate check-ins from a kiosk and record the ones that are accepted in one write.
+        @return: The result of each check-in by its id
+    """
+    keys = registration_keys(items)
+    recorded_anon, *found = db.fan_out(lambda: db.get_kiosk_check_ins(event["uid"]),
+                                       *[lambda key=key: db.get_registration(event["uid"], key) for key in keys])
+    results, registrations, anon = plan(event, items, now, recorded_anon, dict(zip(keys, found)))
+    db.kiosk_check_in(event["uid"], registrations, anon)
+    return results
+
+
+def plan(event, items, now, recorded_anon, existing) -> tuple[dict, dict, dict]:
+    """
+        Validate check-ins from a kiosk, without reading or writing anything.
+        now is the time they arrived, which is recorded as synced for check-ins made before then.
+        recorded_anon holds the ids of anonymous check-ins already recorded (see db.get_kiosk_check_ins), and
+        existing maps the keys found by registration_keys to their public registration.
+        @return: (result of each check-in by its id, registrations to check in, anonymous check-ins to record),
+                 in the form taken by db.kiosk_check_in
+    """
+    schedule = utils.EventSchedule.of(event)
+    results, registrations, anon = {}, {}, {}
+
+    # Earlier check-ins are applied first, so a registration keeps the first time it was checked in
+    for item in sorted(items, key=lambda i: i.get("time") if isinstance(i.get("time"), int) else now):
+        check_in_id, entity, recorded = item.get("id"), item.get("entity"), item.get("time")
+        if not utils.is_key(check_in_id) or not _CHECK_IN_ID.fullmatch(check_in_id) or check_in_id in results:
+            continue
+        if not utils.is_key(entity) or not isinstance(recorded, int) or isinstance(recorded, bool):
+            results[check_in_id] = "CI_INVALID"
+            continue
+        # A kiosk with a fast clock cannot check in from the future
+        recorded = min(recorded, now)
+        if not schedule.checkin_open(datetime.fromtimestamp(recorded, utc)):
+            results[check_in_id] = "EVENT_NOT_RUNNING"
+            continue
+        data = {"time": recorded} | ({"synced": now} if recorded != now else {})
+
+        if entity == "anon":
+            if item.get("visit_reason") not in ANON_AFFILS or not item.get("name"):
+                results[check_in_id] = "CI_INVALID"
+                continue
+            # A replayed check-in was already recorded, so it is not written again
+            if check_in_id not in recorded_anon:
+                anon[check_in_id] = {"rep": item["visit_reason"], "name": str(item["name"])} | data
+            results[check_in_id] = "CHECKED_IN"
+            continue
+
+        if not existing.get(entity):
+            results[check_in_id] = "CI_INVALID"
+            continue
+        previous = registrations.get(entity) or existing[entity].get("checkin_data") or {}
+        if previous.get("checked_in"):
+            # The check-in being replayed was already recorded
+            results[check_in_id] = "CHECKED_IN" if previous.get("kiosk_id") == check_in_id else "CI_ALR"
+            continue
+        registrations[entity] = {"checked_in": True, "kiosk_id": check_in_id} | data
+        results[check_in_id] = "CHECKED_IN"
+
+    return results, registrations, anon
@@ -0,0 +1,109 @@
+"""
+    Event registration service for RoboRegistry
+    @author: Lucas Bubner, 2023
+"""
+
+import math
+from time import time
+
+import db
+import utils
+
+
+# Messages for the reasons db.add_entry may refuse a registration
+REFUSALS = {
+    "REGIS_DISABLED": "Registration for this event has been disabled by the event owner.",
+    "REP_NAME_TAKEN": "Your representing name is already taken. Please choose another.",
+    "EVENT_FULL": "This event has reached maximum capacity for team registrations. You will need to contact the event owner.",
+    "REGIS_BUSY": "Too many registrations are being made for this event right now. Please try again in a moment."
+}
+
+
+class RegistrationError(Exception):
+    """
+        Raised when a registration is refused, with a status code and a message for the user.
+    """
+
+    def __init__(self, code: str, message: str):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+def check_can_register(event, override=False) -> None:
+    """
+        Ensure the current user is allowed to register for an event, before any registration data is given.
+        override is a manual registration by the event owner, which skips the protections for normal registrations.
+        @raise RegistrationError: if the user cannot register
+    """
+    if override:
+        # Ensure we are the event owner
+        if event["creator"] != utils.get_uid():
+            raise RegistrationError("NOT_REGIS_OWNER",
+                                    "The currently logged in RoboRegistry account is not the owner of this event. Only the owner can manually register users.")
+        return
+
+    if event["creator"] == utils.get_uid():
+        raise RegistrationError("REGIS_OWNER",
+                                "The currently logged in RoboRegistry account is the owner of this event. The owner cannot register for their own event.")
+
+    if db.get_registration(event["uid"]):
+        raise RegistrationError("REGIS_ALR",
+                                "You are already registered for this event. If you wish to unregister from this event, please go to the event view tab and unregister from there.")
+
+    # Check if the event has registration manually disabled
+    if not event["settings"]["regis"]:
+        raise RegistrationError("REGIS_DISABLED", REFUSALS["REGIS_DISABLED"])
+
+    # Check to see if the event is over, and decline registration if it is
+    if not utils.EventSchedule.of(event).registration_open():
+        raise RegistrationError("EVENT_AUTO_CLOSED",
+                                "This event has already started or has concluded. Registration has been automatically disabled. You may ask the event owner to register you manually if desired.")
+
+
+def register(event, form, user, override=False) -> None:
+    """
+        Validate registration data and record it for an event.
+        form is the submitted registration form, and user is the data of the current user.
+        override is a manual registration by the event owner, which skips the protections for normal registrations.
+        @raise RegistrationError: if the registration was refused
+    """
+    check_can_register(event, override)
+
+    role = form.get("role")
+    private_data = {
+        "repName": form.get("repName"),
+        "teams": form.get("teams"),
+        "numPeople": form.get("numPeople"),
+        "numStudents": utils.limit_to_999(form.get("numStudents")),
+        "numMentors": utils.limit_to_999(form.get("numMentors")),
+        "numAdults": utils.limit_to_999(form.get("numAdults")),
+        "contactName": form.get("contactName"),
+        "contactEmail": form.get("contactEmail") or user["email"],
+        "contactPhone": utils.reformat_number(form.get("contactPhone")),
+    }
+
+    # Ensure that all required fields are filled
+    if not utils.validate_form(private_data, role):
+        raise RegistrationError("MISSING_FIELDS", "Please fill out all required fields.")
+
+    # Remove data that is not required
+    for key in list(private_data.keys()):
+        if not private_data[key] or role != "team" and key in (
+                "numStudents", "numMentors", "numAdults", "numPeople"):
+            del private_data[key]
+
+    # Check if the repName is already taken
+    if not db.verify_unique(event["uid"], private_data["repName"]):
+        raise RegistrationError("REP_NAME_TAKEN", REFUSALS["REP_NAME_TAKEN"])
+
+    # Log event registration
+    public_data = {
+        "registered_time": math.floor(time()),
+        "role": role
+    }
+
+    # Team registrations take a place from the event's team limit as they are recorded, unless the owner overrides it
+    if refused := db.add_entry(event["uid"], public_data, private_data, override,
+                               limit=-1 if override else event["limit"]):
+        raise RegistrationError(refused, REFUSALS[refused])
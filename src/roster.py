@@ -0,0 +1,143 @@
+"""
+    Check-in roster search for RoboRegistry
+    @author: Lucas Bubner, 2023
+"""
+
+import threading
+import unicodedata
+from bisect import bisect_left
+from itertools import islice
+
+from cachetools import LRUCache
+
+import db
+
+# Events whose roster index is kept in memory at once
+ROSTER_INDEX_EVENTS = 256
+# Results given for a search by default, and the most that may be asked for
+ROSTER_SEARCH_LIMIT = 8
+ROSTER_SEARCH_MAX = 25
+
+# Process-local cache of roster indexes, keyed by event and rebuilt when the event's registrations change
+_indexes = LRUCache(maxsize=ROSTER_INDEX_EVENTS)
+_indexes_lock = threading.Lock()
+
+
+def normalise(text) -> str:
+    """
+        Normalise a name for searching, ignoring case, accents and extra whitespace.
+    """
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.casefold().split())
+
+
+class RosterIndex:
+    """
+        A prefix index over the registrations of an event that are yet to check in.
+        Each registration can be found by the contact's first name, its representing name, or any later word of its
+        representing name, so "rob" finds "CYBER ROBOTICS". Terms are kept in one sorted list, so a search is a
+        binary search followed by a scan of the terms that match.
+        Check-ins do not change the terms, so the index is kept while registrations are only checked in, and the
+        registrations a search would give are checked again once the event has changed since they were last read.
+    """
+
+    def __init__(self, revision, event_revision, registered):
+        """
+            @param revision: The registrations revision of the event the index was built from
+            @param event_revision: The revision of the event the index was built from
+            @param registered: The event's registered tree
+        """
+        self.revision = revision
+        self.entities = {}
+        # Registrations known to have checked in, or to have been removed
+        self.checked_in = set()
+        # The event revision at which each other registration was last seen to not be checked in
+        self._current = {}
+        terms = []
+        for key, registration in (registered or {}).items():
+            if registration.get("checkin_data", {}).get("checked_in"):
+                continue
+            self.entities[key] = registration["entity"]
+            self._current[key] = event_revision
+            # entity has the structure of '{CONTACTNAME} | {REPNAME}'
+            contact, _, repname = registration["entity"].partition(" | ")
+            terms.append((normalise(contact), key))
+            words = normalise(repname).split(" ")
+            terms.extend((" ".join(words[i:]), key) for i in range(len(words)))
+        terms.sort()
+        self._terms = [term for term, _ in terms]
+        self._keys = [key for _, key in terms]
+
+    def search(self, query, limit=ROSTER_SEARCH_LIMIT, event_revision=None, read_checked_in=None) -> list[dict]:
+        """
+            Find the registrations with a term starting with a query.
+            @param event_revision: The current revision of the event
+            @param read_checked_in: Called with registration keys that may have checked in since the event was at
+                                    event_revision, returning those that have checked in or been removed
+            @return: Up to limit matches, as {"key", "entity"} in the order of the terms they matched
+        """
+        query = normalise(query)
+        if not query:
+            return []
+        results = []
+        candidates = self._candidates(query)
+        while len(results) < limit and (batch := list(islice(candidates, limit - len(results)))):
+            if read_checked_in and (stale := [key for key in batch if self._current.get(key) != event_revision]):
+                checked_in = read_checked_in(stale)
+                # Indexes are shared by threads, but each update only ever adds what has been read
+                self.checked_in.update(checked_in)
+                self._current.update((key, event_revision) for key in stale if key not in checked_in)
+            results += [key for key in batch if key not in self.checked_in]
+        return [{"key": key, "entity": self.entities[key]} for key in results]
+
+    def _candidates(self, query):
+        """
+            Yield the keys of the registrations with a term starting with a normalised query, that are not known to
+            have checked in, each once in the order of the terms they matched.
+        """
+        seen = set()
+        i = bisect_left(self._terms, query)
+        while i < len(self._terms) and self._terms[i].startswith(query):
+            key = self._keys[i]
+            if key not in seen and key not in self.checked_in:
+                seen.add(key)
+                yield key
+            i += 1
+
+
+def get_index(event_id) -> RosterIndex:
+    """
+        Get the roster index of an event, building it again if its registrations have changed since it was built.
+    """
+    event = db.get_event_version(event_id)
+    revision = event.get("regis_revision")
+    with _indexes_lock:
+        index = _indexes.get(event_id)
+    # Events that have not had a registration made or removed since these revisions were kept cannot be told apart,
+    # so are always rebuilt
+    if index is None or revision is None or index.revision != revision:
+        index = RosterIndex(revision, event.get("revision"), db.get_event(event_id).get("registered"))
+        if revision is not None:
+            with _indexes_lock:
+                _indexes[event_id] = index
+    return index
+
+
+def search(event_id, query, limit=ROSTER_SEARCH_LIMIT) -> list[dict]:
+    """
+        Search the registrations of an event that are yet to check in, reading only the check-in state of the
+        registrations found if they may have checked in since the index was built.
+    """
+    index = get_index(event_id)
+    return index.search(query, limit, db.get_event_version(event_id).get("revision"),
+                        lambda keys: _read_checked_in(event_id, keys))
+
+
+def _read_checked_in(event_id, keys) -> set:
+    """
+        Find which registrations of an event have checked in or been removed.
+    """
+    registrations = db.fan_out(*[lambda key=key: db.get_registration(event_id, key) for key in keys])
+    return {key for key, registration in zip(keys, registrations)
+            if not registration or registration.get("checkin_data", {}).get("checked_in")}
@@ -1,36 +1,100 @@
 /**
- * RoboRegistry check-in booth script to auto reload upon completion.
+ * RoboRegistry check-in booth script, checking in through the kiosk API.
+ * The roster is fetched once, and each check-in is a single request without reloading the page.
+ * Check-ins made while offline are queued by the kiosk service worker and sent when connectivity returns.
  * @author Lucas Bubner, 2023
  */
 
 document.addEventListener("DOMContentLoaded", () => {
-    document.querySelector("iframe").addEventListener("load", handleLoad);
-    function handleLoad() {
-        const iframe = document.querySelector("iframe");
-
-        // Remove the footer from the iframe as it is already on the page
-        const footer = iframe.contentDocument.querySelector("footer");
-        footer.remove();
-
-        // Check the DOM to see if the form has been submitted and it has gone through successfully
-        // Also reload the page if the user navigates away from the page and onto the view page
-        const success = iframe.contentDocument.querySelector(".headertext");
-        if ((success && success.textContent === "Check in successful") || (!iframe.contentDocument.title.includes("Checking in") && !iframe.contentDocument.title.includes("Event Register"))) {
-            // Restart the iframe by making a brand new one
-            const newIframe = document.createElement("iframe");
-            newIframe.src = iframe.src;
-            newIframe.width = iframe.width;
-            newIframe.height = iframe.height;
-            newIframe.classList = iframe.classList;
-
-            // Replace the old one
-            document.querySelector(".container").appendChild(newIframe);
-            iframe.remove();
-            newIframe.addEventListener("load", handleLoad);
-
-            if (success && success.textContent === "Check in successful") {
-                alert("Check in successful!");
-            }
+    const form = document.getElementById("kiosk-form");
+    const itemSelect = document.getElementById("item-select");
+    const status = document.getElementById("kiosk-status");
+    const base = `/api/kiosk/${form.dataset.event}`;
+    const headers = { "Authorization": `Bearer ${form.dataset.token}` };
+
+    const messages = {
+        CI_INVALID: "You have provided insufficient or invalid data. Please try again.",
+        CI_ALR: "You have already been checked in.",
+        CI_DISABLED: "Check-in for this event has been disabled by the event owner.",
+        EVENT_NOT_RUNNING: "The event is not running, so check-ins are not available.",
+        KIOSK_TOKEN_INVALID: "This booth has expired. Please ask the event owner to restart it."
+    };
+
+    if ("serviceWorker" in navigator) {
+        navigator.serviceWorker.register("/kiosk_sw.js", { scope: "/" });
+        // Replay queued check-ins as soon as we are back online, for browsers without background sync
+        window.addEventListener("online", async () => {
+            const registration = await navigator.serviceWorker.ready;
+            registration.active.postMessage("replay");
+        });
+    }
+
+    async function loadRoster() {
+        let response, data;
+        try {
+            response = await fetch(`${base}/roster`, { headers });
+            data = await response.json();
+        } catch (err) {
+            status.textContent = "Could not reach RoboRegistry. Reload the booth once it is back online.";
+            return;
+        }
+        if (!response.ok) {
+            status.textContent = messages[data.error] || `Failed: ${data.error}`;
+            return;
+        }
+        for (const [key, entity] of Object.entries(data.registered)) {
+            const option = document.createElement("option");
+            option.value = key;
+            option.textContent = entity;
+            itemSelect.appendChild(option);
         }
     }
-});
\ No newline at end of file
+
+    form.addEventListener("submit", async (e) => {
+        e.preventDefault();
+        const entity = itemSelect.value;
+        // The id and time let the check-in be replayed later exactly as it was made, if we are offline
+        const body = { entity, id: crypto.randomUUID(), time: Math.floor(Date.now() / 1000) };
+        if (entity === "anon") {
+            body.visit_reason = document.getElementById("visit-reason-select").value;
+            body.name = document.getElementById("name-input").value;
+        }
+
+        let data;
+        try {
+            const response = await fetch(`${base}/checkin`, {
+                method: "POST",
+                headers: { ...headers, "Content-Type": "application/json" },
+                body: JSON.stringify(body)
+            });
+            data = await response.json();
+        } catch (err) {
+            status.textContent = "Could not reach RoboRegistry. Please try again.";
+            return;
+        }
+        if (data.error) {
+            status.textContent = messages[data.error] || `Failed: ${data.error}`;
+            return;
+        }
+
+        // Registrations can only check in once, so they are taken off the list
+        if (entity !== "anon") {
+            itemSelect.querySelector(`option[value="${CSS.escape(entity)}"]`).remove();
+        }
+        form.reset();
+        itemSelect.dispatchEvent(new Event("change"));
+        status.textContent = "";
+        if (data.status === "QUEUED") {
+            alert("Check in saved! It will be sent to RoboRegistry once the booth is back online.");
+        } else {
+            alert("Check in successful!");
+        }
+    });
+
+    form.addEventListener("reset", () => {
+        status.textContent = "";
+        setTimeout(() => itemSelect.dispatchEvent(new Event("change")));
+    });
+
+    loadRoster();
+});
@@ -0,0 +1,78 @@
+/**
+ * Typeahead search for the dynamic check in page, which does not include the roster.
+ * @author Lucas Bubner, 2023
+ */
+
+document.addEventListener("DOMContentLoaded", () => {
+    const search = document.getElementById("entity-search");
+    const entityInput = document.getElementById("entity-input");
+    const results = document.getElementById("entity-results");
+    const visitReasonDiv = document.getElementById("visit-reason");
+    const anon = results.querySelector("[data-key='anon']");
+    const endpoint = `/events/ci/${search.dataset.event}/search`;
+    let debounce = null;
+    let latest = 0;
+
+    const select = (button) => {
+        entityInput.value = button.dataset.key;
+        for (const other of results.children) {
+            other.classList.toggle("active", other === button);
+        }
+        visitReasonDiv.style.display = entityInput.value === "anon" ? "block" : "none";
+    };
+
+    const render = (matches) => {
+        // Keep the guest option, and replace the matches of the last search
+        results.replaceChildren(anon);
+        for (const { key, entity } of matches) {
+            const button = document.createElement("button");
+            button.type = "button";
+            button.className = "list-group-item list-group-item-action";
+            button.dataset.key = key;
+            button.textContent = entity;
+            results.appendChild(button);
+        }
+        if (entityInput.value !== "anon") {
+            entityInput.value = "";
+        }
+    };
+
+    search.addEventListener("input", () => {
+        clearTimeout(debounce);
+        debounce = setTimeout(async () => {
+            // Responses may arrive out of order, so only the newest search is shown
+            const request = ++latest;
+            if (!search.value.trim()) {
+                render([]);
+                return;
+            }
+            try {
+                const response = await fetch(`${endpoint}?q=${encodeURIComponent(search.value)}`);
+                const data = await response.json();
+                if (request === latest) {
+                    render(data.results || []);
+                }
+            } catch (e) {
+                console.warn("Check in: Could not search the roster.");
+            }
+        }, 150);
+    });
+
+    results.addEventListener("click", (e) => {
+        const button = e.target.closest("button");
+        if (button) {
+            select(button);
+        }
+    });
+
+    search.closest("form").addEventListener("submit", (e) => {
+        if (!entityInput.value) {
+            e.preventDefault();
+            search.setCustomValidity("Please search for and select who you are checking in as.");
+            search.reportValidity();
+        }
+    });
+    search.addEventListener("input", () => search.setCustomValidity(""));
+
+    visitReasonDiv.style.display = "none";
+});
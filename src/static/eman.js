@@ -4,9 +4,13 @@
  */
 let registeredData = null;
 let regisTable = null;
+let registeredCursor = 0;
 
 document.addEventListener("DOMContentLoaded", () => {
     tick();
+    if (!streamRegistrations()) {
+        pollRegistrations();
+    }
 
     const role = document.getElementById("role");
     const numPeople = document.getElementById("numPeople");
@@ -123,6 +127,54 @@ document.addEventListener("DOMContentLoaded", () => {
     setInterval(tick, 30000);
 });
 
+function streamRegistrations() {
+    // Registrations are pushed live by the server where it has streaming enabled, as not every host can stream
+    if (!REGISTRATION_STREAMING || !window.EventSource) return false;
+    const source = new EventSource(`/api/registrations/${EVENT_UID}/stream`);
+    source.addEventListener("snapshot", (e) => updateRegistered(JSON.parse(e.data)));
+    source.addEventListener("delta", (e) => applyRegisteredDelta(JSON.parse(e.data)));
+    source.addEventListener("stream_error", () => {
+        source.close();
+        pollRegistrations();
+    });
+    source.addEventListener("error", () => {
+        // The browser will reconnect by itself unless the stream was refused outright
+        if (source.readyState === EventSource.CLOSED) {
+            pollRegistrations();
+        }
+    });
+    return true;
+}
+
+function pollRegistrations() {
+    fetchRegistrations();
+    setInterval(fetchRegistrations, 30000);
+}
+
+function fetchRegistrations() {
+    // Only ask for what has changed since the last poll
+    api.safeFetch(`/api/registrations/${EVENT_UID}?since=${registeredCursor}`).then((data) => {
+        if (data.cursor === undefined) return;
+        if (registeredData === null) {
+            registeredCursor = data.cursor;
+            updateRegistered(data.changed);
+            return;
+        }
+        registeredCursor = data.cursor;
+        const delta = { ...data.changed };
+        for (const uid of data.removed) {
+            delta[uid] = null;
+        }
+        if (delta.anon_checkin) {
+            // Only new anonymous check-ins are sent, so add them to the ones we already have
+            delta.anon_checkin = { ...registeredData.anon_checkin, ...delta.anon_checkin };
+        }
+        if (Object.keys(delta).length > 0) {
+            applyRegisteredDelta(delta);
+        }
+    });
+}
+
 function submitForm(e) {
     if (document.getElementById("role").value !== "team") return;
     const teams = document.querySelectorAll(".team");
@@ -158,13 +210,74 @@ function tick() {
             document.getElementById("checkin").textContent = "closed.";
         }
     });
+}
 
-    api.safeFetch(`/api/registrations/${EVENT_UID}`).then((data) => {
-        // Little bit of a weird JSON hack, but it works for this application where the data will be in the same order
-        if (JSON.stringify(data) != JSON.stringify(registeredData)) {
-            updateRegistered(data);
+function applyRegisteredDelta(delta) {
+    // Keys are mapped to their new data, or null if they were removed
+    for (const [uid, registration] of Object.entries(delta)) {
+        if (registration === null) {
+            delete registeredData[uid];
+        } else {
+            registeredData[uid] = registration;
         }
-    });
+    }
+    if (!regisTable || regisTable.getDataCount() === 0) {
+        // Nothing was shown before, so the table needs to be built
+        updateRegistered(registeredData);
+        return;
+    }
+    const rows = [];
+    for (const [uid, registration] of Object.entries(delta)) {
+        if (uid == "anon_checkin") {
+            continue;
+        }
+        if (registration === null) {
+            regisTable.deleteRow(uid).catch(() => {});
+        } else {
+            rows.push(toTabulatorRow(uid, registration));
+        }
+    }
+    regisTable.updateOrAddData(rows);
+    if (Object.keys(registeredData).filter((uid) => uid != "anon_checkin").length === 0) {
+        updateRegistered(registeredData);
+    }
+}
+
+function toTabulatorRow(uid, registration) {
+    let teamLength = null;
+    try {
+        teamLength = Object.keys(JSON.parse(registration.teams)).length;
+    } catch (e) {
+        // Problem parsing JSON, keep as null
+    }
+    if (registration.role === "team") {
+        return {
+            id: uid,
+            name: registration.repName,
+            time: luxon.DateTime.fromSeconds(registration.registered_time),
+            role: registration.role,
+            contactName: registration.contactName,
+            contactEmail: registration.contactEmail,
+            contactPhone: registration.contactPhone || "N/A",
+            numAdults: registration.numAdults,
+            numMentors: registration.numMentors,
+            numStudents: registration.numStudents,
+            numPeople: registration.numPeople,
+            numTeams: teamLength || "error",
+            teamList: registration.teams,
+            isManual: uid.startsWith("-N")
+        };
+    }
+    return {
+        id: uid,
+        name: registration.repName,
+        time: luxon.DateTime.fromSeconds(registration.registered_time),
+        role: registration.role,
+        contactName: registration.contactName,
+        contactEmail: registration.contactEmail,
+        contactPhone: registration.contactPhone || "N/A",
+        isManual: uid.startsWith("-N")
+    };
 }
 
 function updateRegistered(data) {
@@ -174,41 +287,7 @@ function updateRegistered(data) {
         if (uid == "anon_checkin") {
             continue;
         }
-        let teamLength = null;
-        try {
-            teamLength = Object.keys(JSON.parse(registration.teams)).length;
-        } catch (e) {
-            // Problem parsing JSON, keep as null
-        }
-        if (registration.role === "team") {
-            tabulatorData.push({
-                id: uid,
-                name: registration.repName,
-                time: luxon.DateTime.fromSeconds(registration.registered_time),
-                role: registration.role,
-                contactName: registration.contactName,
-                contactEmail: registration.contactEmail,
-                contactPhone: registration.contactPhone || "N/A",
-                numAdults: registration.numAdults,
-                numMentors: registration.numMentors,
-                numStudents: registration.numStudents,
-                numPeople: registration.numPeople,
-                numTeams: teamLength || "error",
-                teamList: registration.teams,
-                isManual: uid.startsWith("-N")
-            });
-        } else {
-            tabulatorData.push({
-                id: uid,
-                name: registration.repName,
-                time: luxon.DateTime.fromSeconds(registration.registered_time),
-                role: registration.role,
-                contactName: registration.contactName,
-                contactEmail: registration.contactEmail,
-                contactPhone: registration.contactPhone || "N/A",
-                isManual: uid.startsWith("-N")
-            });
-        }
+        tabulatorData.push(toTabulatorRow(uid, registration));
     }
     try {
         regisTable = new Tabulator("#registered-table", {
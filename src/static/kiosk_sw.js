@@ -0,0 +1,119 @@
+/**
+ * RoboRegistry service worker for check-in kiosks.
+ * Check-ins that cannot reach RoboRegistry are queued locally, and replayed in batches when connectivity returns.
+ * @author Lucas Bubner, 2023
+ */
+
+const DB_NAME = "kiosk";
+const BATCH_SIZE = 100;
+const SYNC_TAG = "kiosk-replay";
+const CHECKIN_PATH = /^\/api\/kiosk\/([^/]+)\/checkin$/;
+
+self.addEventListener("install", () => self.skipWaiting());
+self.addEventListener("activate", (e) => e.waitUntil(self.clients.claim()));
+
+self.addEventListener("fetch", (e) => {
+    const url = new URL(e.request.url);
+    const match = url.pathname.match(CHECKIN_PATH);
+    if (e.request.method !== "POST" || url.origin !== self.location.origin || !match) {
+        return;
+    }
+    e.respondWith(checkIn(e.request, decodeURIComponent(match[1])));
+});
+
+self.addEventListener("sync", (e) => {
+    if (e.tag === SYNC_TAG) {
+        e.waitUntil(replay());
+    }
+});
+
+self.addEventListener("message", (e) => {
+    // Pages tell us when they come back online, for browsers without background sync
+    if (e.data === "replay") {
+        e.waitUntil(replay().catch(() => {}));
+    }
+});
+
+async function checkIn(request, event) {
+    const item = await request.clone().json();
+    // The latest token of each event is kept, so queued check-ins can be sent after the booth is restarted
+    await transact(["tokens"], "readwrite", (tx) => tx.objectStore("tokens").put(request.headers.get("Authorization"), event));
+    try {
+        const response = await fetch(request);
+        // Anything the server answered is final, but it is a good time to send what is waiting
+        replay().catch(() => {});
+        return response;
+    } catch (err) {
+        // The kiosk gives every check-in an id and time, so it can be sent again later as it was made
+        await transact(["checkins"], "readwrite", (tx) => tx.objectStore("checkins").put({ event, item }));
+        if (self.registration.sync) {
+            self.registration.sync.register(SYNC_TAG).catch(() => {});
+        }
+        return new Response(JSON.stringify({ status: "QUEUED" }), {
+            status: 202,
+            headers: { "Content-Type": "application/json" }
+        });
+    }
+}
+
+function openDB() {
+    return new Promise((resolve, reject) => {
+        const req = indexedDB.open(DB_NAME, 1);
+        req.onupgradeneeded = () => {
+            req.result.createObjectStore("checkins", { keyPath: "item.id" });
+            req.result.createObjectStore("tokens");
+        };
+        req.onsuccess = () => resolve(req.result);
+        req.onerror = () => reject(req.error);
+    });
+}
+
+function transact(stores, mode, fn) {
+    return openDB().then((db) => new Promise((resolve, reject) => {
+        const tx = db.transaction(stores, mode);
+        const result = fn(tx);
+        tx.oncomplete = () => resolve(result.result);
+        tx.onerror = () => reject(tx.error);
+    }));
+}
+
+let replaying = null;
+
+function replay() {
+    // Only one replay runs at a time, so check-ins are not sent twice at once
+    replaying = replaying || sendQueued().finally(() => replaying = null);
+    return replaying;
+}
+
+async function sendQueued() {
+    const queued = await transact(["checkins"], "readonly", (tx) => tx.objectStore("checkins").getAll());
+    const events = {};
+    for (const { event, item } of queued) {
+        (events[event] = events[event] || []).push(item);
+    }
+    for (const [event, items] of Object.entries(events)) {
+        const token = await transact(["tokens"], "readonly", (tx) => tx.objectStore("tokens").get(event));
+        for (let i = 0; i < items.length; i += BATCH_SIZE) {
+            const response = await fetch(`/api/kiosk/${encodeURIComponent(event)}/batch`, {
+                method: "POST",
+                headers: { "Authorization": token, "Content-Type": "application/json" },
+                body: JSON.stringify({ checkins: items.slice(i, i + BATCH_SIZE) })
+            });
+            if (!response.ok) {
+                // Leave everything queued to try again later, such as once the booth has a new token
+                console.warn(`Kiosk: Replay for '${event}' failed with status ${response.status}.`);
+                break;
+            }
+            const { results } = await response.json();
+            await transact(["checkins"], "readwrite", (tx) => {
+                for (const id of Object.keys(results)) {
+                    if (results[id] !== "CHECKED_IN") {
+                        console.warn(`Kiosk: Check-in '${id}' was refused with ${results[id]}.`);
+                    }
+                    tx.objectStore("checkins").delete(id);
+                }
+                return {};
+            });
+        }
+    }
+}
@@ -0,0 +1,113 @@
+"""
+    Tests for event schedules in RoboRegistry, around daylight saving changes
+    Run with: python -m pytest
+    @author: Lucas Bubner, 2023
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from pytz import utc
+
+from utils import EventSchedule
+
+ADELAIDE = "Australia/Adelaide"
+# Clocks go forward from 02:00 ACST (UTC+9:30) to 03:00 ACDT (UTC+10:30)
+SPRING_FORWARD = "2023-10-01"
+# Clocks go back from 03:00 ACDT (UTC+10:30) to 02:00 ACST (UTC+9:30)
+FALL_BACK = "2024-04-07"
+
+
+def schedule(date, start_time, end_time, tz_name=ADELAIDE) -> EventSchedule:
+    """
+        Get the schedule of an event with the given fields.
+    """
+    return EventSchedule.of({"date": date, "start_time": start_time, "end_time": end_time, "timezone": tz_name})
+
+
+def at(*args) -> datetime:
+    """
+        Make a UTC datetime.
+    """
+    return datetime(*args, tzinfo=utc)
+
+
+def test_ordinary_day():
+    event = schedule("2023-08-01", "09:00", "17:00")
+    assert event.start == at(2023, 7, 31, 23, 30)
+    assert event.end == at(2023, 8, 1, 7, 30)
+    assert event.utc_offset == 9.5
+
+
+def test_spring_forward_day_uses_daylight_time():
+    event = schedule(SPRING_FORWARD, "09:00", "17:00")
+    assert event.start == at(2023, 9, 30, 22, 30)
+    assert event.end - event.start == timedelta(hours=8)
+    assert event.utc_offset == 10.5
+
+
+def test_spring_forward_start_in_gap_is_not_zero_length():
+    # 02:30 does not exist, so the event starts at 01:30 ACST, an hour before 03:30 ACDT
+    event = schedule(SPRING_FORWARD, "02:30", "03:30")
+    assert event.start == at(2023, 9, 30, 16)
+    assert event.end == at(2023, 9, 30, 17)
+    assert event.checkin_open(at(2023, 9, 30, 16, 30))
+
+
+def test_spring_forward_end_in_gap():
+    # 02:30 does not exist, so the event ends at 03:30 ACDT
+    event = schedule(SPRING_FORWARD, "01:30", "02:30")
+    assert event.start == at(2023, 9, 30, 16)
+    assert event.end == at(2023, 9, 30, 17)
+
+
+def test_spring_forward_across_gap():
+    event = schedule(SPRING_FORWARD, "01:00", "04:00")
+    assert event.end - event.start == timedelta(hours=2)
+
+
+def test_fall_back_day_uses_standard_time():
+    event = schedule(FALL_BACK, "09:00", "17:00")
+    assert event.start == at(2024, 4, 6, 23, 30)
+    assert event.end - event.start == timedelta(hours=8)
+    assert event.utc_offset == 9.5
+
+
+def test_fall_back_repeated_times_cover_both_occurrences():
+    # 02:15 and 02:45 each happen twice, so the event runs from the first 02:15 to the second 02:45
+    event = schedule(FALL_BACK, "02:15", "02:45")
+    assert event.start == at(2024, 4, 6, 15, 45)
+    assert event.end == at(2024, 4, 6, 17, 15)
+    assert event.utc_offset == 10.5
+
+
+def test_fall_back_across_repeated_hour():
+    event = schedule(FALL_BACK, "01:00", "04:00")
+    assert event.end - event.start == timedelta(hours=4)
+
+
+@pytest.mark.parametrize("date, start_time, end_time", [
+    (SPRING_FORWARD, "02:00", "02:59"),
+    (SPRING_FORWARD, "02:30", "03:00"),
+    (FALL_BACK, "02:00", "02:00"),
+    (FALL_BACK, "02:59", "03:00"),
+])
+def test_never_ends_before_it_starts(date, start_time, end_time):
+    event = schedule(date, start_time, end_time)
+    assert event.start <= event.end
+
+
+def test_phases_around_spring_forward():
+    event = schedule(SPRING_FORWARD, "02:30", "03:30")
+    assert event.phase(at(2023, 9, 30, 15, 59)) == (0, None)
+    assert event.registration_open(at(2023, 9, 30, 15, 59))
+    assert event.phase(at(2023, 9, 30, 16, 30)) == (1, event.start.timestamp())
+    assert event.phase(at(2023, 9, 30, 17, 1)) == (2, event.end.timestamp())
+    assert event.ended(at(2023, 9, 30, 17, 1))
+
+
+def test_is_event_day_in_event_timezone():
+    event = schedule(SPRING_FORWARD, "09:00", "17:00")
+    # 23:00 UTC on the 30th is already the 1st in Adelaide
+    assert event.is_event_day(at(2023, 9, 30, 23))
+    assert not event.is_event_day(at(2023, 9, 30, 13))
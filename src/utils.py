@@ -3,9 +3,13 @@
     @author: Lucas Bubner, 2023
 """
 from datetime import datetime
+from functools import lru_cache
+from typing import NamedTuple
 
 from flask import Blueprint
 from flask_login import current_user
+from pytz import timezone, utc
+from pytz.tzinfo import BaseTzInfo
 
 filter_bp = Blueprint("filters", __name__, template_folder="templates")
 
@@ -46,6 +50,82 @@ def get_time_diff(start_time, end_time):
     return days, hours, minutes
 
 
+class EventSchedule(NamedTuple):
+    """
+        When an event runs, as UTC instants parsed from its date, times and timezone.
+        Use EventSchedule.of(event), which parses each version of an event's schedule only once.
+        Methods take the time to check against as now, which defaults to the current time.
+    """
+    tz: BaseTzInfo
+    start: datetime
+    end: datetime
+
+    @staticmethod
+    def of(event) -> "EventSchedule":
+        """
+            Get the schedule of an event.
+        """
+        return _event_schedule(event["date"], event["start_time"], event["end_time"], event["timezone"])
+
+    @property
+    def utc_offset(self) -> float:
+        """
+            Hours the event's timezone is ahead of UTC, at the time the event starts.
+        """
+        return self.start.astimezone(self.tz).utcoffset().total_seconds() / 3600
+
+    def registration_open(self, now=None) -> bool:
+        """
+            Registration automatically closes once the event starts.
+        """
+        return (now or datetime.now(utc)) < self.start
+
+    def checkin_open(self, now=None) -> bool:
+        """
+            Check-in is automatically open while the event is running.
+        """
+        return self.start <= (now or datetime.now(utc)) <= self.end
+
+    def ended(self, now=None) -> bool:
+        """
+            Whether the event has finished.
+        """
+        return (now or datetime.now(utc)) > self.end
+
+    def is_event_day(self, now=None) -> bool:
+        """
+            Whether it is the day of the event in the event's timezone.
+        """
+        return (now or datetime.now(utc)).astimezone(self.tz).date() == self.start.astimezone(self.tz).date()
+
+    def phase(self, now=None) -> tuple[int, float | None]:
+        """
+            Find how far through the event we are, being 0 before it starts, 1 while it is running and 2 once it has ended.
+            @return: (phase, timestamp the phase began, or None before the event starts)
+        """
+        if self.registration_open(now):
+            return 0, None
+        if not self.ended(now):
+            return 1, self.start.timestamp()
+        return 2, self.end.timestamp()
+
+
+@lru_cache(maxsize=1024)
+def _event_schedule(date, start_time, end_time, tz_name) -> EventSchedule:
+    """
+        Parse an event schedule, cached by its fields so it is only parsed again when the event is changed.
+    """
+    tz = timezone(tz_name)
+    # Times that daylight saving skips or repeats resolve to the widest window, so an event is never cut short:
+    # the start takes the earlier instant it could mean, and the end takes the later one.
+    # A skipped start is read with the offset after clocks go forward, so 02:30 when 02:00 becomes 03:00 is 01:30
+    # standard time, while a skipped end is read with the offset before, being 03:30 daylight time.
+    # A repeated start is its first occurrence, and a repeated end is its second.
+    start = tz.localize(datetime.strptime(f"{date} {start_time}", "%Y-%m-%d %H:%M"), is_dst=True)
+    end = tz.localize(datetime.strptime(f"{date} {end_time}", "%Y-%m-%d %H:%M"), is_dst=False)
+    return EventSchedule(tz, start.astimezone(utc), end.astimezone(utc))
+
+
 def limit_to_999(value):
     """
         Limit a value to 0-999 and safe cast to int.
@@ -107,6 +187,13 @@ def validate_email(email):
     return True
 
 
+def is_key(value) -> bool:
+    """
+        Whether a value from a user can be used as a Firebase key, without reaching any other node.
+    """
+    return isinstance(value, str) and bool(value) and not any(c in value for c in ".$#[]/")
+
+
 def get_uid():
     """
         Fetch the localId for the current user.
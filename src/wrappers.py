@@ -2,15 +2,16 @@
     RoboRegistry route wrappers
     @author: Lucas Bubner, 2023
 """
+import hashlib
 from datetime import datetime
 from functools import wraps
 
-from flask import session, request, redirect, abort, render_template, url_for
+from flask import session, request, redirect, abort, render_template, url_for, make_response, Response
 from flask_login import current_user, AnonymousUserMixin
-from pytz import timezone
+from pytz import utc
 
 import utils
-from db import get_uid_for, get_event, logged_out_data
+from db import get_uid_for, get_event_meta, logged_out_data
 
 
 def must_be_event_owner(f):
@@ -27,26 +28,32 @@ def must_be_event_owner(f):
     return check
 
 
-def event_must_be_running(f):
+def event_must_be_running(f=None, *, json=False):
     """
         Ensure an event is running to allow requests to be made.
+        With json, routes that answer with JSON are refused with a JSON error instead of a page.
     """
 
-    @wraps(f)
-    def check(event_id, *args, **kwargs):
-        event = get_event(event_id)
-        if not event:
+    def decorator(f):
+        @wraps(f)
+        def check(event_id, *args, **kwargs):
+            event = get_event_meta(event_id)
+            if not event:
+                return f(event_id, *args, **kwargs)
+            if not utils.EventSchedule.of(event).checkin_open():
+                if json:
+                    return {
+                        "error": "EVENT_NOT_RUNNING"
+                    }, 400
+                return render_template("event/done.html.jinja", status="Failed: EVENT_NOT_RUNNING",
+                                       message="We are unable to check you in as the event is not running. If the event has already concluded, it is no longer possible to check in. If the event is yet to start, we'll automatically enable check-ins when it is time.",
+                                       event=event, user=getattr(current_user, "data", logged_out_data)), 400
             return f(event_id, *args, **kwargs)
-        start_time = datetime.strptime(event["start_time"], "%H:%M").time()
-        end_time = datetime.strptime(event["end_time"], "%H:%M").time()
-        if not start_time <= datetime.now(timezone(event["timezone"])).time() <= end_time or not str(datetime.now(
-                timezone(event["timezone"])).date()) == event["date"]:
-            return render_template("event/done.html.jinja", status="Failed: EVENT_NOT_RUNNING",
-                                   message="We are unable to check you in as the event is not running. If the event has already concluded, it is no longer possible to check in. If the event is yet to start, we'll automatically enable check-ins when it is time.",
-                                   event=event, user=getattr(current_user, "data", logged_out_data)), 400
-        return f(event_id, *args, **kwargs)
 
-    return check
+        return check
+
+    # Used either bare or with arguments
+    return decorator(f) if f else decorator
 
 
 def validate_user(f):
@@ -70,3 +77,58 @@ def validate_user(f):
         return f(*args, **kwargs)
 
     return check
+
+
+def make_validators(name, uid, version) -> tuple[str, datetime | None]:
+    """
+        Build the ETag and Last-Modified time of a response from the result of a conditional validator.
+        name identifies the route, and uid the user the response is for.
+    """
+    parts, last_modified = version
+    etag = hashlib.sha256(repr((name, uid, *parts)).encode()).hexdigest()[:32]
+    return etag, datetime.fromtimestamp(int(last_modified), utc) if last_modified else None
+
+
+def is_not_modified(etag, last_modified, if_none_match, if_modified_since) -> bool:
+    """
+        Determine if a client's cached response is still valid from its conditional request headers.
+    """
+    # If-None-Match takes precedence, and browsers send both when they have an ETag
+    if if_none_match:
+        return if_none_match.contains_weak(etag)
+    return bool(last_modified and if_modified_since and last_modified <= if_modified_since)
+
+
+def conditional(validator):
+    """
+        Answer conditional GET requests with 304 Not Modified before the route does any work.
+        validator is called with the route's arguments, and returns (parts, last_modified) where parts is a tuple of
+        everything the response depends on and last_modified is the timestamp it last changed at, if known.
+        The validator may return None if the response cannot be validated, in which case the route always runs.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def check(*args, **kwargs):
+            # Flashed messages are only shown once, so pages with them pending must always be rendered
+            if request.method != "GET" or session.get("_flashes") or not (version := validator(*args, **kwargs)):
+                return f(*args, **kwargs)
+            etag, last_modified = make_validators(f.__name__, utils.get_uid(), version)
+
+            if is_not_modified(etag, last_modified, request.if_none_match, request.if_modified_since):
+                res = Response(status=304)
+            else:
+                res = make_response(f(*args, **kwargs))
+                if res.status_code != 200:
+                    return res
+
+            res.set_etag(etag, weak=True)
+            if last_modified:
+                res.last_modified = last_modified
+            # Responses are specific to the user, and must be revalidated every time they are used
+            res.headers["Cache-Control"] = "private, no-cache"
+            return res
+
+        return check
+
+    return decorator
@@ -0,0 +1,222 @@
+"""
+    Write-behind queue for batching database writes in RoboRegistry
+    @author: Lucas Bubner, 2023
+"""
+
+import atexit
+import json
+import os
+import sqlite3
+import threading
+import uuid
+import warnings
+from time import time
+
+
+class WriteBehindQueue:
+    """
+        A durable queue of database writes, which are flushed together as one multi-location update.
+        Writes are stored in a local SQLite database before being acknowledged, so they survive a crash and are
+        flushed by the next process to use the same file. Writes to a path that is already queued are ignored,
+        so the first write to each path is the one kept.
+        Every process using the same file flushes it, so each flush claims the writes it sends first, and a write is
+        only sent by another process once its claim is older than lease, such as when its process has crashed.
+        Writes are delivered at least once, as an update that times out may have been applied, so flush must be
+        safe to call again with writes it has already made.
+        A write that is rejected on its own max_attempts times is moved to the dead_writes table, so it cannot stay
+        queued forever. Dead writes are kept for inspection, and are not retried.
+    """
+
+    def __init__(self, path, interval, flush, rejected=lambda e: True, max_attempts=3, lease=300):
+        """
+            @param path: The file to store queued writes in
+            @param interval: Seconds between flushes
+            @param flush: Called from the flushing thread with (paths, event_ids), where paths maps each database
+                          path to its value and event_ids are the events written to. Raising leaves the writes queued.
+            @param rejected: Whether an exception raised by flush means the write was refused, rather than failing
+                             for a reason that will pass, such as an outage. Only refusals count towards max_attempts.
+            @param max_attempts: Times a write may be refused on its own before it is moved to dead_writes
+            @param lease: Seconds a flush has to send the writes it claimed before other processes may send them
+        """
+        self.path = path
+        self.interval = interval
+        self._flush = flush
+        self._rejected = rejected
+        self.max_attempts = max_attempts
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._conn = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def _db(self) -> sqlite3.Connection:
+        """
+            Get the connection to the queue file for this process, starting the flushing thread with it.
+            Must be called while holding the lock.
+        """
+        # A forked worker process cannot use the connection or thread of its parent
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS writes (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "path TEXT UNIQUE, value TEXT, event_id TEXT, attempts INTEGER NOT NULL DEFAULT 0, "
+                               "claim TEXT, claimed_at REAL)")
+            # Queue files from before writes were retried on their own or claimed are missing those columns
+            columns = [column[1] for column in self._conn.execute("PRAGMA table_info(writes)")]
+            for column, definition in (("attempts", "INTEGER NOT NULL DEFAULT 0"), ("claim", "TEXT"),
+                                       ("claimed_at", "REAL")):
+                if column not in columns:
+                    self._conn.execute(f"ALTER TABLE writes ADD COLUMN {column} {definition}")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS dead_writes (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                               "path TEXT, value TEXT, event_id TEXT, error TEXT, failed_at REAL)")
+            self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+            self._thread.start()
+        return self._conn
+
+    def put(self, path, value, event_id) -> bool:
+        """
+            Queue a write to a database path.
+            @return: False if a write to this path was already queued, in which case this write is ignored
+        """
+        with self._lock:
+            cursor = self._db().execute("INSERT OR IGNORE INTO writes (path, value, event_id) VALUES (?, ?, ?)",
+                                        (path, json.dumps(value), event_id))
+        return cursor.rowcount == 1
+
+    def pending(self) -> int:
+        """
+            The number of writes waiting to be flushed.
+        """
+        with self._lock:
+            return self._db().execute("SELECT COUNT(*) FROM writes").fetchone()[0]
+
+    def flush(self) -> bool:
+        """
+            Write everything queued so far in one update.
+            If the update is refused, the writes of each event are tried separately, and then each write of an event
+            that still fails is tried on its own, so one bad write cannot hold up the rest. Any other failure leaves
+            the whole batch for the next flush.
+            @return: True if the queue was flushed, or False if some writes failed
+        """
+        token = uuid.uuid4().hex
+        try:
+            rows = self._claim(token)
+        except sqlite3.OperationalError as e:
+            # Another process held the queue file for too long, so its writes are left for the next flush
+            warnings.warn(f"Could not claim queued writes, retrying: {e}")
+            return False
+        if not rows:
+            return True
+        try:
+            return self._write_claimed(rows)
+        finally:
+            with self._lock:
+                # Writes left in the queue may be sent by the next flush of any process
+                self._db().execute("UPDATE writes SET claim = NULL, claimed_at = NULL WHERE claim = ?", (token,))
+
+    def _claim(self, token) -> list:
+        """
+            Claim every queued write that is not claimed by another flush, or whose claim has expired.
+            @return: The rows claimed, as (id, path, value, event_id, attempts)
+        """
+        now = time()
+        with self._lock:
+            conn = self._db()
+            # An immediate transaction holds the file's write lock, so other processes cannot claim the same writes
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute("UPDATE writes SET claim = ?, claimed_at = ? WHERE claim IS NULL OR claimed_at < ?",
+                             (token, now, now - self.lease))
+                rows = conn.execute("SELECT id, path, value, event_id, attempts FROM writes WHERE claim = ? "
+                                    "ORDER BY id", (token,)).fetchall()
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        return rows
+
+    def _write_claimed(self, rows) -> bool:
+        """
+            Write claimed rows, narrowing down the writes that fail.
+            @return: True if every row was written
+        """
+        if (error := self._write(rows)) is None:
+            return True
+        # A failure that will pass, such as an outage, would fail every smaller update too, so the whole batch is
+        # left for the next flush rather than sending more updates to a service that is down
+        if not self._rejected(error):
+            return False
+        events = {}
+        for row in rows:
+            events.setdefault(row[3], []).append(row)
+        flushed = True
+        for event_rows in events.values():
+            # A single event's writes were just tried together
+            if len(events) > 1:
+                if (error := self._write(event_rows)) is None:
+                    continue
+                if not self._rejected(error):
+                    return False
+            for row in event_rows:
+                if (error := self._write([row])) is None:
+                    continue
+                if not self._rejected(error):
+                    return False
+                flushed = False
+                self._retry_later(row, error)
+        return flushed
+
+    def _write(self, rows) -> Exception | None:
+        """
+            Write queued rows in one update, removing them from the queue if it succeeds.
+            @return: The exception raised if the update failed
+        """
+        try:
+            self._flush({row[1]: json.loads(row[2]) for row in rows}, {row[3] for row in rows})
+        except Exception as e:
+            warnings.warn(f"Failed to flush {len(rows)} queued writes, retrying: {e}")
+            return e
+        with self._lock:
+            # Rows are removed by id, as more writes may have been queued since they were read
+            self._db().executemany("DELETE FROM writes WHERE id = ?", [(row[0],) for row in rows])
+        return None
+
+    def _retry_later(self, row, error) -> None:
+        """
+            Count a refusal of a write on its own, moving it to dead_writes once it has used all of its attempts.
+        """
+        row_id, path, value, event_id, attempts = row
+        with self._lock:
+            if attempts + 1 < self.max_attempts:
+                self._db().execute("UPDATE writes SET attempts = attempts + 1 WHERE id = ?", (row_id,))
+                return
+            self._db().execute("INSERT INTO dead_writes (path, value, event_id, error, failed_at) "
+                               "VALUES (?, ?, ?, ?, ?)", (path, value, event_id, str(error), time()))
+            self._db().execute("DELETE FROM writes WHERE id = ?", (row_id,))
+        warnings.warn(f"Gave up on queued write to {path} after {self.max_attempts} attempts: {error}")
+
+    def close(self) -> None:
+        """
+            Stop the flushing thread and drain the queue.
+        """
+        # A process that never used the queue has nothing to drain, and a forked process must not flush the writes
+        # of its parent
+        if self._pid != os.getpid():
+            return
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        # Try a few times so a brief outage during shutdown does not leave writes behind
+        for _ in range(3):
+            if self.flush():
+                break
+
+    def _run(self) -> None:
+        """
+            Flush the queue periodically until the queue is closed.
+        """
+        while not self._stop.wait(self.interval):
+            self.flush()